@@ -11,7 +11,7 @@
 # FOR A PARTICULAR PURPOSE.
 #
 ##############################################################################
-name, version = 'zc.zk', '2.1.0'
+name, version = 'zc.zk', '2.2.0.dev0'
 
 install_requires = ['setuptools', 'zc.thread', 'kazoo']
 extras_require = dict(
@@ -25,6 +25,7 @@ entry_points = """
 zookeeper_set_property = zc.zk.scripts:set_property
 zookeeper_export = zc.zk.scripts:export
 zookeeper_import = zc.zk.scripts:import_
+zookeeper_diff = zc.zk.scripts:diff
 zookeeper_validate = zc.zk.scripts:validate_
 """
 
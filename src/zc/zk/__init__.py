@@ -11,16 +11,23 @@
 # FOR A PARTICULAR PURPOSE.
 #
 ##############################################################################
+import base64
+import bisect
 import collections
+import itertools
 import json
 import logging
+import mmap
 import os
+import Queue
 import re
 import socket
+import struct
 import sys
 import threading
 import time
 import weakref
+import zlib
 import zc.zk.event
 import zc.thread
 import kazoo.client
@@ -54,6 +61,11 @@ def decode(sdata, path='?'):
         data = dict(string_value = sdata)
     return data
 
+def _same_value(a, b):
+    # Compare property values (or whole properties) as JSON, because
+    # 1 == True == 1.0 in Python, but they're different values.
+    return json.dumps(a, sort_keys=True) == json.dumps(b, sort_keys=True)
+
 def join(*args):
     return '/'.join(args)
 
@@ -109,14 +121,143 @@ class Resolving:
             raise kazoo.exceptions.NoNodeError(path)
 
 aliases = 'exists', 'create', 'delete', 'get_children', 'get'
+async_aliases = (
+    'get_async', 'get_children_async', 'get_acls_async',
+    'create_async', 'set_async', 'set_acls_async', 'delete_async',
+    )
+
+_instrumentations = weakref.WeakSet()
+_zookeepers = weakref.WeakSet() # open ZooKeeper objects, for monitoring
+_zookeeper_numbers = itertools.count() # creation order, for monitoring
+
+class Instrumentation:
+    """Record counts, latencies and errors of ZooKeeper operations
+
+    Statistics are kept per operation and per operation for each
+    path prefix, made up of the first ``prefix_depth`` path
+    components.  Latencies are counted in a histogram with upper
+    bounds, in seconds, given by ``buckets``.  The last histogram
+    count is for latencies greater than the last bucket.
+    """
+
+    buckets = (.001, .005, .01, .05, .1, .5, 1.0, 5.0)
+
+    def __init__(self, name=None, prefix_depth=2, buckets=None):
+        self.name = name
+        self.prefix_depth = prefix_depth
+        if buckets is not None:
+            self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+        _instrumentations.add(self)
+
+    def reset(self):
+        with self._lock:
+            self.operations = {}
+            self.prefixes = {}
+
+    def prefix(self, path):
+        if not isinstance(path, basestring):
+            return None
+        return '/' + '/'.join(
+            [n for n in path.split('/') if n][:self.prefix_depth])
+
+    def wrap(self, name, func):
+        """Return a function that calls func and records the call
+        """
+        def instrumented(path, *args, **kw):
+            start = time.time()
+            try:
+                result = func(path, *args, **kw)
+            except Exception, v:
+                self.record(name, path, time.time() - start, v)
+                raise
+            self.record(name, path, time.time() - start)
+            return result
+        instrumented.__name__ = name
+        return instrumented
+
+    def wrap_async(self, name, func):
+        """Return a function that calls func, which returns an
+        asynchronous result, and records the call when it completes
+        """
+        def instrumented(*args, **kw):
+            start = time.time()
+            result = func(*args, **kw)
+            path = args[0] if args else None
+            def completed(result):
+                self.record(name, path, time.time() - start,
+                            result.exception)
+            result.rawlink(completed)
+            return result
+        instrumented.__name__ = name
+        return instrumented
+
+    def record(self, name, path, elapsed, error=None):
+        bucket = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if elapsed <= bound:
+                bucket = i
+                break
+        prefix = self.prefix(path)
+        if error is not None:
+            error = error.__class__.__name__
+        with self._lock:
+            stats = [self.operations]
+            if prefix is not None:
+                stats.append(self.prefixes.setdefault(prefix, {}))
+            for operations in stats:
+                op = operations.get(name)
+                if op is None:
+                    op = operations[name] = dict(
+                        count=0, time=0.0, errors={},
+                        histogram=[0] * (len(self.buckets) + 1))
+                op['count'] += 1
+                op['time'] += elapsed
+                op['histogram'][bucket] += 1
+                if error is not None:
+                    op['errors'][error] = op['errors'].get(error, 0) + 1
+
+    def stats(self):
+        """Return the statistics as a dictionary suitable for JSON
+        """
+        with self._lock:
+            return json.loads(json.dumps(dict(
+                name=self.name,
+                buckets=self.buckets,
+                operations=self.operations,
+                prefixes=self.prefixes,
+                )))
+
+    def operation_stats(self):
+        """Return the buckets and per-operation statistics
+
+        Unlike ``stats``, the path-prefix statistics aren't copied, so
+        the cost doesn't depend on the number of prefixes seen.
+        """
+        with self._lock:
+            return dict(
+                buckets=list(self.buckets),
+                operations=dict(
+                    (name, dict(op, errors=dict(op['errors']),
+                                histogram=list(op['histogram'])))
+                    for name, op in self.operations.iteritems()),
+                )
 
 class ZooKeeper(Resolving):
 
+    # With a snapshot, we don't have to wait long for ZooKeeper at
+    # start up, as watches can be served from the snapshot.
+    snapshot_start_timeout = 1.0
+
     def __init__(
         self,
         connection_string=None,
         session_timeout=None,
-        wait = False
+        wait = False,
+        snapshot = None,
+        instrumentation = None,
+        slow_callback_threshold = None,
         ):
 
         if session_timeout is None:
@@ -132,21 +273,54 @@ class ZooKeeper(Resolving):
             client = kazoo.client.KazooClient(
                 connection_string, session_timeout)
             started = False
+            self.connection_string = connection_string
         else:
             client = connection_string
             started = True
             self.close = lambda : None
+            self.connection_string = None
 
         self.client = client
-        for alias in aliases:
-            setattr(self, alias, getattr(client, alias))
+        if instrumentation is True:
+            instrumentation = Instrumentation(
+                connection_string if isinstance(connection_string, basestring)
+                else None)
+        self.instrumentation = instrumentation
+        for alias in aliases + ('set', ):
+            func = getattr(client, alias)
+            if instrumentation is not None:
+                func = instrumentation.wrap(alias, func)
+            if alias in ('set', 'delete'):
+                alias = '_' + alias
+            setattr(self, alias, func)
+
+        # Requests made by bulk operations, like walk and
+        # apply_changes, are recorded under the same names.
+        for alias in async_aliases:
+            func = getattr(client, alias)
+            if instrumentation is not None:
+                func = instrumentation.wrap_async(alias[:-6], func)
+            setattr(self, '_' + alias, func)
 
         self.ephemeral = {}
         self.state = None
 
+        if isinstance(snapshot, basestring):
+            snapshot = load_snapshot(snapshot)
+        self.snapshot = snapshot
+        self._unreconciled = []
+        self._unreconciled_lock = threading.Lock()
+        self.slow_callback_threshold = slow_callback_threshold
+        self._watches = weakref.WeakSet()
+        self.session_history = collections.deque(maxlen=20)
+        self.last_restore = None
+        self._number = next(_zookeeper_numbers)
+        _zookeepers.add(self)
+
         def watch_session(state):
             restore = False
             logger.info("watch_session %s" % state)
+            self.session_history.append((time.time(), state))
             if state == kazoo.protocol.states.KazooState.CONNECTED:
                 restore = self.state == kazoo.protocol.states.KazooState.LOST
                 logger.info('connected')
@@ -155,35 +329,92 @@ class ZooKeeper(Resolving):
             if restore:
                 @zc.thread.Thread
                 def restore():
-                    for path, data in list(self.ephemeral.items()):
+                    started = time.time()
+                    ephemeral = list(self.ephemeral.items())
+                    for path, data in ephemeral:
                         logger.info("restoring ephemeral %s", path)
                         try:
                             self.create(
                                 path, data['data'], data['acl'], ephemeral=True)
                         except kazoo.exceptions.NodeExistsError:
                             pass # threads? <shrug>
+                    self.last_restore = dict(
+                        time=started, duration=time.time() - started,
+                        nodes=len(ephemeral))
+
+            if (state == kazoo.protocol.states.KazooState.CONNECTED and
+                self._unreconciled):
+                self._reconcile()
 
         client.add_listener(watch_session)
 
         if started:
             watch_session(client.state)
         else:
+            start_options = {}
+            if snapshot is not None:
+                start_options['timeout'] = self.snapshot_start_timeout
             while 1:
                 try:
-                    client.start()
+                    client.start(**start_options)
                 except Exception:
                     logger.critical("Can't connect to ZooKeeper at %r",
                                     connection_string)
                     if wait:
                         time.sleep(1)
+                    elif snapshot is not None:
+                        # We can serve watches from the snapshot until
+                        # we connect.
+                        self._connect_in_background(connection_string)
+                        break
                     else:
                         raise FailedConnect(connection_string)
                 else:
                     break
 
+    def _connect_in_background(self, connection_string):
+
+        @zc.thread.Thread
+        def connect():
+            while 1:
+                time.sleep(1)
+                if (self.closed or
+                    self.state == kazoo.protocol.states.KazooState.CONNECTED):
+                    break
+                try:
+                    self.client.start()
+                except Exception:
+                    logger.critical("Can't connect to ZooKeeper at %r",
+                                    connection_string)
+                else:
+                    break
+
+    def _reconcile_later(self, watch):
+        # Called by watches initialized from the snapshot.
+        with self._unreconciled_lock:
+            self._unreconciled.append(watch)
+        if self.state == kazoo.protocol.states.KazooState.CONNECTED:
+            self._reconcile()
+
+    def _reconcile(self):
+
+        @zc.thread.Thread
+        def reconcile():
+            with self._unreconciled_lock:
+                watches = self._unreconciled
+                self._unreconciled = []
+            for watch in watches:
+                watch.register(False)
+
     def get_properties(self, path):
         return decode(self.get(path)[0], path)
 
+    def _commit_async(self, transaction):
+        if self.instrumentation is None:
+            return transaction.commit_async()
+        return self.instrumentation.wrap_async(
+            'transaction', transaction.commit_async)()
+
     def _findallipv4addrs(self, tail):
         try:
             import netifaces
@@ -215,6 +446,7 @@ class ZooKeeper(Resolving):
             addrs = (addr,)
 
         path = self.resolve(path)
+        server = addr, path
         zc.zk.event.notify(RegisteringServer(addr, path, kw))
         if path != '/':
             path += '/'
@@ -223,32 +455,94 @@ class ZooKeeper(Resolving):
             data = encode(kw)
             apath = path + addr
             self.create(apath, data, acl, ephemeral=True)
-            self.ephemeral[apath] = dict(data=data, acl=acl)
+            self.ephemeral[apath] = dict(data=data, acl=acl, server=server)
 
     register_server = register # backward compatibility
 
     def set(self, path, data, *a, **k):
-        r = self.client.set(path, data, *a, **k)
+        r = self._set(path, data, *a, **k)
         if path in self.ephemeral:
             self.ephemeral[path]['data'] = data
         return r
 
-    def children(self, path):
-        return Children(self, path)
+    def delete(self, path, *a, **k):
+        r = self._delete(path, *a, **k)
+        self._forget_ephemeral(path)
+        return r
 
-    def properties(self, path, watch=True):
-        return Properties(self, path, watch)
+    def _forget_ephemeral(self, path):
+        # Stop tracking (and restoring) an ephemeral node we registered.
+        # When the last node for a registration goes away, let
+        # subscribers know.
+        info = self.ephemeral.pop(path, None)
+        if info is None or info.get('server') is None:
+            return
+        server = info['server']
+        for other in self.ephemeral.values():
+            if other.get('server') == server:
+                return
+        zc.zk.event.notify(UnregisteringServer(*server))
+
+    def children(self, path, executor=None, sequence=False):
+        if sequence:
+            return SequenceChildren(self, path, executor=executor)
+        return Children(self, path, executor=executor)
+
+    def watch_stats(self):
+        # Return delivery statistics for the watches in use, slowest
+        # callbacks first.
+        stats = []
+        for watch in list(self._watches):
+            data = dict(watch.metrics)
+            data['path'] = watch.path
+            data['type'] = watch.__class__.__name__
+            stats.append(data)
+        stats.sort(key=lambda data: data['callback_time'], reverse=True)
+        return stats
+
+    def properties(self, path, watch=True, executor=None):
+        return Properties(self, path, watch, executor=executor)
 
     def import_tree(self, text, path='/', trim=None, acl=OPEN_ACL_UNSAFE,
-                    dry_run=False):
+                    dry_run=False, concurrency=16):
         while path.endswith('/'):
             path = path[:-1] # Mainly to deal w root: /
-        self._import_tree(path, parse_tree(text), acl, trim, dry_run, True)
+        tree = parse_tree(text)
+        # Fetch the nodes being imported, and their ACLs, up front,
+        # with pipelined requests, rather than a node at a time.
+        live = self._fetch_tree(path, tree, False, concurrency)
+        acls = self._fetch_acls(sorted(live), concurrency)
+        counts = collections.Counter()
+        self._import_tree(path, tree, acl, trim, dry_run, live, acls, counts,
+                          True)
+        if not dry_run:
+            logger.info(
+                "imported %s: %s created, %s updated, %s unchanged",
+                path or '/',
+                counts['created'], counts['updated'], counts['unchanged'])
+
+    def _fetch_acls(self, paths, concurrency):
+        # {path -> (acl, stat)} for the paths that exist
+        acls = {}
+        for i in xrange(0, len(paths), concurrency):
+            requests = [(p, self._get_acls_async(p))
+                        for p in paths[i:i+concurrency]]
+            for p, result in requests:
+                try:
+                    acls[p] = result.get()
+                except kazoo.exceptions.NoNodeError:
+                    pass
+        return acls
 
-    def _import_tree(self, path, node, acl, trim, dry_run, top=False):
+    def _import_tree(self, path, node, acl, trim, dry_run, live, acls, counts,
+                     top=False):
         if not top:
             new_children = set(node.children)
-            for name in sorted(self.get_children(path)):
+            if path in live:
+                children = live[path][2]
+            else:
+                children = () # We just created it.
+            for name in sorted(children):
                 if name in new_children:
                     continue
                 cpath = join(path, name)
@@ -261,44 +555,208 @@ class ZooKeeper(Resolving):
         for name, child in sorted(node.children.iteritems()):
             cpath = path + '/' + name
             data = encode(child.properties)
-            if self.exists(cpath):
-                if dry_run:
-                    new = child.properties
-                    old = self.get_properties(cpath)
-                    old = decode(self.get(cpath)[0])
-                    for n, v in sorted(old.items()):
-                        if n not in new:
-                            if n.endswith(' ->'):
-                                print '%s remove link %s %s' % (cpath, n, v)
-                            else:
-                                print '%s remove property %s = %s' % (
-                                    cpath, n, v)
-                        elif new[n] != v:
-                            if n.endswith(' ->'):
-                                print '%s %s link change from %s to %s' % (
-                                    cpath, n[:-3], v, new[n])
-                            else:
-                                print '%s %s change from %s to %s' % (
-                                    cpath, n, v, new[n])
-                    for n, v in sorted(new.items()):
-                        if n not in old:
-                            if n.endswith(' ->'):
-                                print '%s add link %s %s' % (cpath, n, v)
-                            else:
-                                print '%s add property %s = %s' % (
-                                    cpath, n, v)
+            if cpath in live:
+                if cpath in acls:
+                    oldacl, meta = acls[cpath]
                 else:
-                    self.set(cpath, data)
                     oldacl, meta = self.client.get_acls(cpath)
+                if dry_run:
+                    for line in describe_property_changes(
+                        cpath, decode(live[cpath][0], cpath),
+                        child.properties):
+                        print line
+                    if acl != oldacl:
+                        print cpath, 'acl change'
+                else:
+                    # Avoid writes that would only bump versions and
+                    # trigger watches.
+                    old = live[cpath][0]
+                    if data == old or _same_value(decode(old, cpath),
+                                                 child.properties):
+                        counts['unchanged'] += 1
+                    else:
+                        self.set(cpath, data)
+                        counts['updated'] += 1
                     if acl != oldacl:
-                        self.client.set_acls(cpath, meta.aversion, acl)
+                        self.client.set_acls(cpath, acl, meta.aversion)
             else:
                 if dry_run:
                     print 'add', cpath
                     continue
                 else:
                     self.create(cpath, data, acl)
-            self._import_tree(cpath, child, acl, trim, dry_run)
+                    counts['created'] += 1
+            self._import_tree(cpath, child, acl, trim, dry_run, live, acls,
+                              counts)
+
+    def diff_tree(self, text, path='/', trim=None, acl=OPEN_ACL_UNSAFE,
+                  concurrency=16):
+        # Like import_tree(..., dry_run=True), but rather than printing
+        # changes, return a list of Change objects, in the order
+        # import_tree would make them.  The nodes involved are fetched
+        # up front, a level at a time, with pipelined requests.
+        while path.endswith('/'):
+            path = path[:-1]
+        tree = parse_tree(text)
+        live = self._fetch_tree(path, tree, trim, concurrency)
+        acls = self._fetch_acls(
+            [p for p in _tree_paths(path, tree) if p in live], concurrency)
+        changes = []
+        self._diff_tree(path, tree, live, acls, acl, trim, changes, True)
+        return changes
+
+    def _fetch_nodes(self, paths, concurrency):
+        # {path -> (data, stat, children)} for the paths that exist
+        nodes = {}
+        for i in xrange(0, len(paths), concurrency):
+            requests = [(p, self._get_async(p), self._get_children_async(p))
+                        for p in paths[i:i+concurrency]]
+            for p, get_result, children_result in requests:
+                try:
+                    data, stat = get_result.get()
+                    children = children_result.get()
+                except kazoo.exceptions.NoNodeError:
+                    continue
+                nodes[p] = data, stat, children
+        return nodes
+
+    def _fetch_tree(self, path, tree, trim, concurrency):
+        # Fetch the existing nodes that importing the tree at the path
+        # would touch.  When trimming, that includes the trees under
+        # nodes that aren't in the import.
+        live = {}
+        level = [(join(path, name), child)
+                 for name, child in tree.children.iteritems()]
+        while level:
+            fetched = self._fetch_nodes([p for (p, _) in level], concurrency)
+            live.update(fetched)
+            next_level = []
+            for p, node in level:
+                if p not in fetched:
+                    continue
+                for name in fetched[p][2]:
+                    child = node and node.children.get(name)
+                    if child is not None or trim:
+                        next_level.append((join(p, name), child))
+            level = next_level
+        return live
+
+    def _diff_tree(self, path, node, live, acls, acl, trim, changes,
+                   top=False):
+        if not top:
+            for name in sorted(live[path][2]):
+                if name in node.children:
+                    continue
+                cpath = join(path, name)
+                if trim:
+                    self._diff_delete(cpath, live, changes)
+                elif trim is None:
+                    changes.append(Change('extra', cpath))
+
+        for name, child in sorted(node.children.iteritems()):
+            cpath = join(path, name)
+            data = encode(child.properties)
+            if cpath in live:
+                old, stat, _ = live[cpath]
+                if not (data == old or
+                        _same_value(decode(old, cpath), child.properties)):
+                    changes.append(Change('set', cpath, data,
+                                          version=stat.version, old=old))
+                if cpath in acls and acls[cpath][0] != acl:
+                    changes.append(Change('set_acls', cpath, acl=acl,
+                                          version=acls[cpath][1].aversion))
+                self._diff_tree(cpath, child, live, acls, acl, trim, changes)
+            else:
+                self._diff_create(cpath, child, acl, changes)
+
+    def _diff_create(self, path, node, acl, changes):
+        changes.append(Change('create', path, encode(node.properties), acl))
+        for name, child in sorted(node.children.iteritems()):
+            self._diff_create(join(path, name), child, acl, changes)
+
+    def _diff_delete(self, path, live, changes):
+        # Add deletes for a tree, children first, leaving ephemeral
+        # nodes and their ancestors alone, as delete_recursive would.
+        # Return whether there was an ephemeral node.
+        data, stat, children = live[path]
+        ephemeral = bool(stat.ephemeralOwner)
+        for name in sorted(children):
+            cpath = join(path, name)
+            if cpath in live:
+                ephemeral = self._diff_delete(cpath, live, changes) or ephemeral
+        if not ephemeral:
+            changes.append(Change('delete', path, version=stat.version))
+        return ephemeral
+
+    def apply_changes(self, changes, concurrency=16, batch=1):
+        # Apply Change objects, such as those returned by diff_tree.
+        # Changes are applied in waves, so parents are created before
+        # their children and children are deleted before their
+        # parents.  Within a wave, up to concurrency requests are
+        # outstanding at once.  If batch is greater than 1, creates,
+        # sets and deletes are grouped into transactions of up to
+        # batch operations.
+        #
+        # Each applied change's elapsed attribute is set to the time,
+        # in seconds, taken by the request that applied it.  If a
+        # request fails, outstanding requests are waited for and the
+        # error is raised, leaving the elapsed attributes of changes
+        # that weren't applied set to None.
+        applied = []
+        for wave in _change_waves(changes):
+            if batch > 1:
+                requests = [[change] for change in wave
+                            if change.op == 'set_acls']
+                ops = [change for change in wave if change.op != 'set_acls']
+                requests.extend(ops[i:i+batch]
+                                for i in xrange(0, len(ops), batch))
+            else:
+                requests = [[change] for change in wave]
+
+            error = None
+            for i in xrange(0, len(requests), concurrency):
+                pending = [(group, time.time(), self._apply_async(group))
+                           for group in requests[i:i+concurrency]]
+                for group, started, result in pending:
+                    try:
+                        _check_applied(result.get())
+                    except Exception, v:
+                        if error is None:
+                            error = v
+                        continue
+                    elapsed = time.time() - started
+                    for change in group:
+                        change.elapsed = elapsed
+                    applied.extend(group)
+                if error is not None:
+                    raise error
+        return applied
+
+    def _apply_async(self, group):
+        if len(group) == 1:
+            [change] = group
+            op = change.op
+            if op == 'create':
+                return self._create_async(change.path, change.data,
+                                          change.acl)
+            elif op == 'set':
+                return self._set_async(change.path, change.data,
+                                       change.version)
+            elif op == 'set_acls':
+                return self._set_acls_async(change.path, change.acl,
+                                            change.version)
+            else:
+                return self._delete_async(change.path, change.version)
+
+        transaction = self.client.transaction()
+        for change in group:
+            if change.op == 'create':
+                transaction.create(change.path, change.data, change.acl)
+            elif change.op == 'set':
+                transaction.set_data(change.path, change.data, change.version)
+            else:
+                transaction.delete(change.path, change.version)
+        return self._commit_async(transaction)
 
     def delete_recursive(self, path, dry_run=False, force=False,
                          ignore_if_ephemeral=False):
@@ -340,40 +798,50 @@ class ZooKeeper(Resolving):
         output = []
         out = output.append
 
-        def export_tree(path, indent, name=None):
-            children = self.get_children(path)
-            if path == '/':
-                path = ''
-                if 'zookeeper' in children:
-                    children.remove('zookeeper')
-                if name is not None:
-                    out(indent + '/' + name)
-                    indent += '  '
-            else:
-                data, meta = self.get(path)
-                if meta.ephemeralOwner and not ephemeral:
-                    return
-                if name is None:
-                    name = path.rsplit('/', 1)[1]
-                properties = decode(data)
-                type_ = properties.pop('type', None)
-                if type_:
-                    name += ' : '+type_
-                out(indent + '/' + name)
-                indent += '  '
-                links = []
-                for i in sorted(properties.iteritems()):
-                    if i[0].endswith(' ->'):
-                        links.append(i)
-                    else:
-                        out(indent+"%s = %r" % i)
-                for i in links:
-                    out(indent+"%s %s" % i)
+        def export_node(path, data, stat, indent, name=None):
+            if stat.ephemeralOwner and not ephemeral:
+                return
+            if name is None:
+                name = path.rsplit('/', 1)[1]
+            properties = decode(data)
+            type_ = properties.pop('type', None)
+            if type_:
+                name += ' : '+type_
+            out(indent + '/' + name)
+            indent += '  '
+            links = []
+            for i in sorted(properties.iteritems()):
+                if i[0].endswith(' ->'):
+                    links.append(i)
+                else:
+                    out(indent+"%s = %r" % i)
+            for i in links:
+                out(indent+"%s %s" % i)
 
-            for name in sorted(children):
-                export_tree(path+'/'+name, indent)
+        nodes = self.walk(path, children=True, data=True)
+        try:
+            top, children, data, stat = nodes.next()
+        except StopIteration:
+            raise kazoo.exceptions.NoNodeError(path)
+
+        # Indentation of the children of nodes output so far
+        indents = {}
+        if path == '/':
+            if 'zookeeper' in children:
+                children.remove('zookeeper')
+            indents[top] = ''
+            if name is not None:
+                out('/' + name)
+                indents[top] = '  '
+        else:
+            export_node(top, data, stat, '', name)
+            indents[top] = '  '
+
+        for path, data, stat in nodes:
+            indent = indents[path.rsplit('/', 1)[0] or '/']
+            export_node(path, data, stat, indent)
+            indents[path] = indent + '  '
 
-        export_tree(path, '', name)
         return '\n'.join(output)+'\n'
 
     def print_tree(self, path='/'):
@@ -387,29 +855,164 @@ class ZooKeeper(Resolving):
         properties[name+' ->'] = target
         self.set(base, encode(properties))
 
+    closed = False
     def close(self):
+        self.closed = True
         self.client.stop()
         self.client.close()
         self.close = lambda : None
+        _zookeepers.discard(self)
+        for path in sorted(self.ephemeral):
+            self._forget_ephemeral(path)
+
+    def status(self):
+        # Return a summary of the object's state suitable for JSON.
+        watches = {}
+        for watch in list(self._watches):
+            counts = watches.setdefault(watch.path, {})
+            kind = watch.__class__.__name__
+            counts[kind] = counts.get(kind, 0) + 1
+        instrumentation = self.instrumentation
+        return dict(
+            connection=self.connection_string,
+            state=self.state,
+            session_history=list(self.session_history),
+            last_restore=self.last_restore,
+            ephemeral=sorted(self.ephemeral),
+            watches=watches,
+            operations=(instrumentation.operation_stats()['operations']
+                        if instrumentation is not None else None),
+            )
+
+    def walk(self, path='/', ephemeral=True, children=False, data=False,
+             concurrency=16):
+        # The zc.zk.testing mock server can walk trees itself, much
+        # faster than we can by making requests.
+        walk = getattr(self.client, 'walk', None)
+        if walk is not None:
+            return walk(path, ephemeral, children, data)
+        return self._walk(path, ephemeral, children, data, concurrency)
+
+    def _walk(self, path, ephemeral, children, data, concurrency):
+        # Nodes are yielded depth first, in sorted order, as they
+        # always have been, but rather than making a round trip per
+        # node, we keep requests for the next ``concurrency`` nodes in
+        # flight.  A node's children aren't queued until after it's
+        # been yielded, so callers can still prune the walk by removing
+        # names from the children list.  Nodes that have already been
+        # requested are yielded even if they're changed or deleted
+        # before we get to them, so pruning by changing the tree as we
+        # go only works with a concurrency of 1.
+        #
+        # The ephemeral and children options only apply to the
+        # starting node.
+        concurrency = max(concurrency, 1)
+        top = path
+        stack = [path]
+        pending = {}
+        while stack:
+            for p in stack[:-concurrency-1:-1]:
+                if p not in pending:
+                    pending[p] = (
+                        self._get_children_async(p),
+                        self._get_async(p)
+                        if data or (p is top and not ephemeral) else None,
+                        )
+
+            path = stack.pop()
+            children_result, get_result = pending.pop(path)
+            try:
+                if get_result is not None:
+                    node_data, stat = get_result.get()
+                    if path is top and not ephemeral and stat.ephemeralOwner:
+                        return
+                _children = sorted(children_result.get())
+            except kazoo.exceptions.NoNodeError:
+                continue
+
+            item = (path, )
+            if children and path is top:
+                item += (_children, )
+            if data:
+                item += (node_data, stat)
+            yield item if len(item) > 1 else path
 
-    def walk(self, path='/', ephemeral=True, children=False):
-        try:
-            if not ephemeral and self.get(path)[1].ephemeralOwner:
-                return
-
-            _children = sorted(self.get_children(path))
-            if children:
-                yield path, _children
-            else:
-                yield path
-        except kazoo.exceptions.NoNodeError:
-            return
-
-        for name in _children:
             if path != '/':
-                name = '/'+name
-            for p in self.walk(path+name):
-                yield p
+                base = path + '/'
+            else:
+                base = '/'
+            stack.extend(base + name for name in reversed(_children))
+
+    def save_snapshot(self, filename, path='/', mapped=False):
+        # Write and rename, so a process starting while we're writing
+        # doesn't see a partial snapshot.
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            if mapped:
+                self._save_mapped_snapshot(f, path)
+            else:
+                self._save_snapshot(f, path)
+        os.rename(tmp, filename)
+
+    def _save_snapshot(self, f, path):
+        nodes = {}
+        for p, data, stat in self.walk(path, data=True):
+            node = nodes[p] = dict(version=stat.version,
+                                   ephemeral=bool(stat.ephemeralOwner),
+                                   children=[])
+            if isinstance(data, str):
+                try:
+                    data = data.decode('utf8')
+                except UnicodeDecodeError:
+                    # Binary data, which JSON can't represent.
+                    data = base64.b64encode(data)
+                    node['base64'] = True
+            node['data'] = data
+            if p != path:
+                base, name = p.rsplit('/', 1)
+                nodes[base or '/']['children'].append(name)
+
+        json.dump(dict(path=path, nodes=nodes), f, separators=(',',':'))
+
+    def _save_mapped_snapshot(self, f, path):
+        # See MappedSnapshot for the format.  Paths and data are
+        # written as we walk. Only the (small) index entries are kept
+        # in memory, to be sorted and written at the end.
+        root = path.encode('utf8')
+        f.write(_mapped_header.pack(_mapped_magic, 0, 0, len(root)))
+        f.write(root)
+        offset = f.tell()
+
+        entries = []
+        nchildren = collections.defaultdict(int)
+        for p, data, stat in self.walk(path, data=True):
+            p = p.encode('utf8')
+            key = _mapped_key(p)
+            if p != root:
+                nchildren[_mapped_key(key[0])] += 1
+            f.write(p)
+            if data is None:
+                data_len = -1
+            else:
+                if isinstance(data, unicode):
+                    data = data.encode('utf8')
+                f.write(data)
+                data_len = len(data)
+            entries.append((key, offset, len(p), data_len, stat.version,
+                            bool(stat.ephemeralOwner)))
+            offset += len(p) + max(data_len, 0)
+
+        entries.sort()
+        for key, path_offset, path_len, data_len, version, ephemeral in (
+            entries):
+            f.write(_mapped_entry.pack(
+                path_offset, path_len, path_offset + path_len, data_len,
+                version, ephemeral, nchildren.get(key, 0),
+                ))
+
+        f.seek(0)
+        f.write(_mapped_header.pack(
+            _mapped_magic, len(entries), offset, len(root)))
 
     def create_recursive(self, path, data, acl):
         self.client.ensure_path(path, acl)
@@ -421,6 +1024,535 @@ class ZooKeeper(Resolving):
 
 ZK = ZooKeeper
 
+class ZooKeeperPool:
+    """Spread traffic over several ZooKeeper sessions.
+
+    Operations on a single path, including watches, are always sent
+    to the same session, chosen by hashing the path, so they're
+    ordered with respect to each other.  Ephemeral nodes, including
+    server registrations, and operations on whole trees use the first
+    (primary) session.
+    """
+
+    # Operations on a single path (or tree, for the primary).
+    _path_operations = (
+        'exists', 'get', 'get_children', 'get_properties', 'set',
+        'delete', 'children', 'properties', 'is_ephemeral',
+        )
+
+    def __init__(self, connection_string=None, size=2, **kw):
+        if size < 1:
+            raise ValueError("size must be at least 1", size)
+        self.sessions = [ZooKeeper(connection_string, **kw)
+                         for i in range(size)]
+        self.primary = self.sessions[0]
+
+    def session(self, path):
+        """Return the session used for the given path.
+        """
+        if path in self.primary.ephemeral:
+            return self.primary
+        return self.sessions[
+            (zlib.crc32(path.encode('utf8') if isinstance(path, unicode)
+                        else path) & 0xffffffff) % len(self.sessions)]
+
+    def __getattr__(self, name):
+        if name in self._path_operations:
+            def operation(path, *args, **kw):
+                return getattr(self.session(path), name)(path, *args, **kw)
+            operation.__name__ = name
+            return operation
+        return getattr(self.primary, name)
+
+    def create(self, path, *args, **kw):
+        ephemeral = kw.get('ephemeral', args[2] if len(args) > 2 else False)
+        session = self.primary if ephemeral else self.session(path)
+        return session.create(path, *args, **kw)
+
+    def watch_stats(self):
+        return sorted((stats for session in self.sessions
+                       for stats in session.watch_stats()),
+                      key=lambda stats: stats['callback_time'],
+                      reverse=True)
+
+    def status(self):
+        return [session.status() for session in self.sessions]
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
+
+class WorkQueue:
+    """A work queue made of the sequence-node children of a node
+
+    Consumers claim items in batches.  The children are cached, in
+    order, from a single child watch, and a batch is claimed by
+    fetching the first unclaimed items with pipelined requests and
+    then deleting them all in one transaction, so each batch takes
+    two round trips, however many items it has.  Items are removed
+    when they're claimed, so an item is never given to more than one
+    consumer, but an item is lost if its consumer fails before
+    processing it.
+    """
+
+    def __init__(self, zk, path, batch=100, prefix='item-'):
+        self.zk = zk
+        self.path = path
+        self.batch = batch
+        self.prefix = prefix
+        if not zk.exists(path):
+            zk.client.ensure_path(path)
+        # Names of items known to have been claimed, that the
+        # children watch may not have caught up with yet.
+        self._gone = set()
+        self._changed = threading.Condition()
+        self.children = zk.children(path, sequence=True)
+        self.children(self._children_changed)
+
+    def _children_changed(self, children):
+        with self._changed:
+            self._gone.difference_update(children.removed)
+            self._changed.notify_all()
+
+    def __len__(self):
+        with self._changed:
+            return len(self.children) - len(self._gone)
+
+    def put(self, value):
+        """Add an item, returning its path
+        """
+        return self.zk.create(
+            self.path + '/' + self.prefix, value, sequence=True)
+
+    def put_all(self, values):
+        """Add items in a single transaction, returning their paths
+        """
+        transaction = self.zk.client.transaction()
+        for value in values:
+            transaction.create(
+                self.path + '/' + self.prefix, value, sequence=True)
+        result = self.zk._commit_async(transaction).get()
+        _check_applied(result)
+        return result
+
+    def get(self, timeout=0):
+        """Claim a batch of items, returning their values, oldest first
+
+        If no items are available, wait up to ``timeout`` seconds (or
+        indefinitely, if ``timeout`` is None) for some to be added.
+        An empty list is returned if none are.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while 1:
+            values = self._claim()
+            if values:
+                return values
+            with self._changed:
+                if self._unclaimed():
+                    continue
+                if deadline is None:
+                    self._changed.wait()
+                else:
+                    wait = deadline - time.time()
+                    if wait <= 0:
+                        return []
+                    self._changed.wait(wait)
+
+    def _unclaimed(self):
+        # Return the first unclaimed item names.  Call with
+        # self._changed acquired.
+        gone = self._gone
+        names = []
+        for name in self.children:
+            if name not in gone:
+                names.append(name)
+                if len(names) >= self.batch:
+                    break
+        return names
+
+    def _claim(self):
+        with self._changed:
+            names = self._unclaimed()
+        zk = self.zk
+        base = self.path + '/'
+        while names:
+            fetched = [(name, zk._get_async(base + name))
+                       for name in names]
+            items = []
+            gone = []
+            for name, result in fetched:
+                try:
+                    data, stat = result.get()
+                except kazoo.exceptions.NoNodeError:
+                    gone.append(name)
+                else:
+                    items.append((name, data, stat.version))
+            if items:
+                transaction = zk.client.transaction()
+                for name, data, version in items:
+                    transaction.delete(base + name, version)
+                result = zk._commit_async(transaction).get()
+                failed = [
+                    (items[i][0], r) for (i, r) in enumerate(result)
+                    if isinstance(r, Exception) and
+                    not isinstance(r, kazoo.exceptions.RolledBackError)]
+                if not failed:
+                    gone.extend(name for name, data, version in items)
+            else:
+                failed = ()
+
+            gone.extend(name for name, error in failed
+                        if isinstance(error, kazoo.exceptions.NoNodeError))
+            with self._changed:
+                # Unless the children watch has already seen them go.
+                self._gone.update(
+                    name for name in gone if name in self.children)
+
+            if items and not failed:
+                return [data for name, data, version in items]
+
+            # Another consumer got some of the items first (or
+            # changed them). Try again without the failed items.
+            failed = set(name for name, error in failed)
+            names = [name for name, data, version in items
+                     if name not in failed]
+
+        return []
+
+    def close(self):
+        """Stop watching the queue
+        """
+        if self._children_changed in self.children.callbacks:
+            self.children.callbacks.remove(self._children_changed)
+
+def describe_property_changes(path, old, new):
+    lines = []
+    for n, v in sorted(old.items()):
+        if n not in new:
+            if n.endswith(' ->'):
+                lines.append('%s remove link %s %s' % (path, n, v))
+            else:
+                lines.append('%s remove property %s = %s' % (path, n, v))
+        elif not _same_value(new[n], v):
+            if n.endswith(' ->'):
+                lines.append('%s %s link change from %s to %s' % (
+                    path, n[:-3], v, new[n]))
+            else:
+                lines.append('%s %s change from %s to %s' % (
+                    path, n, v, new[n]))
+    for n, v in sorted(new.items()):
+        if n not in old:
+            if n.endswith(' ->'):
+                lines.append('%s add link %s %s' % (path, n, v))
+            else:
+                lines.append('%s add property %s = %s' % (path, n, v))
+    return lines
+
+def _tree_paths(path, node):
+    for name, child in node.children.iteritems():
+        cpath = join(path, name)
+        yield cpath
+        for p in _tree_paths(cpath, child):
+            yield p
+
+def _change_waves(changes):
+    # Group changes into lists that can be applied concurrently,
+    # keeping their order within each list.
+    creates = set(c.path for c in changes if c.op == 'create')
+    deletes = set(c.path for c in changes if c.op == 'delete')
+
+    def depth(path):
+        # The number of ancestors of a path being created
+        n = 0
+        path = path.rsplit('/', 1)[0]
+        while path in creates:
+            n += 1
+            path = path.rsplit('/', 1)[0]
+        return n
+
+    heights = dict.fromkeys(deletes, 0)
+    for path in deletes:
+        n = 1
+        path = path.rsplit('/', 1)[0]
+        while path in deletes:
+            heights[path] = max(heights[path], n)
+            n += 1
+            path = path.rsplit('/', 1)[0]
+
+    levels = []
+    for change in changes:
+        if change.op == 'create':
+            level = depth(change.path)
+        elif change.op in ('set', 'set_acls'):
+            level = 0
+            if change.path in creates:
+                level = depth(change.path) + 1
+        elif change.op == 'delete':
+            level = None
+        elif change.op == 'extra':
+            continue
+        else:
+            raise ValueError("Unknown change operation", change.op)
+        levels.append((level, change))
+
+    waves = []
+    for level, change in levels:
+        if level is not None:
+            while len(waves) <= level:
+                waves.append([])
+            waves[level].append(change)
+    offset = len(waves)
+    for level, change in levels:
+        if level is None:
+            level = offset + heights[change.path]
+            while len(waves) <= level:
+                waves.append([])
+            waves[level].append(change)
+    return waves
+
+def _check_applied(result):
+    # Transactions return lists of results rather than raising errors.
+    if isinstance(result, list):
+        for r in result:
+            if (isinstance(r, Exception) and
+                not isinstance(r, kazoo.exceptions.RolledBackError)):
+                raise r
+
+class Change:
+    """A change to a ZooKeeper tree, as computed by ``diff_tree``
+
+    Attributes:
+
+    op
+      The operation: 'create', 'set', 'set_acls' or 'delete'.
+      'extra' changes are informational. They note nodes that aren't
+      in an imported tree and that weren't trimmed.
+    path
+      The node path.
+    data
+      The new node data, for 'create' and 'set' changes.
+    acl
+      The access-control list, for 'create' and 'set_acls' changes.
+    version
+      The node version the change was computed against, or -1.  For
+      'set_acls' changes, this is the ACL version.
+    old
+      The old node data, for 'set' changes.
+    elapsed
+      The time, in seconds, taken to apply the change with
+      ``apply_changes``, or None if it hasn't been applied.
+    """
+
+    elapsed = None
+
+    def __init__(self, op, path, data=None, acl=None, version=-1, old=None):
+        self.op = op
+        self.path = path
+        self.data = data
+        self.acl = acl
+        self.version = version
+        self.old = old
+
+    def describe(self):
+        """Return a list of lines describing the change.
+        """
+        if self.op == 'set':
+            return describe_property_changes(
+                self.path, decode(self.old, self.path),
+                decode(self.data, self.path))
+        elif self.op == 'create':
+            return ['add %s' % self.path]
+        elif self.op == 'delete':
+            return ['delete %s' % self.path]
+        elif self.op == 'set_acls':
+            return ['%s acl change' % self.path]
+        elif self.op == 'extra':
+            return ['extra path not trimmed: %s' % self.path]
+        else:
+            return ['%s %s' % (self.op, self.path)]
+
+    def __repr__(self):
+        return "Change(%r, %r)" % (self.op, self.path)
+
+SnapshotStat = collections.namedtuple(
+    'SnapshotStat', 'version ephemeralOwner numChildren')
+
+def load_snapshot(filename):
+    with open(filename, 'rb') as f:
+        magic = f.read(len(_mapped_magic))
+    if magic == _mapped_magic:
+        return MappedSnapshot(filename)
+    else:
+        return Snapshot(filename)
+
+class Snapshot(Resolving):
+    """Read-only view of a tree saved with ``ZooKeeper.save_snapshot``
+    """
+
+    def __init__(self, filename):
+        with open(filename) as f:
+            snapshot = json.load(f)
+        self.path = snapshot['path']
+        self.nodes = snapshot['nodes']
+
+    def exists(self, path):
+        node = self.nodes.get(path)
+        if node is not None:
+            return SnapshotStat(
+                node['version'], node['ephemeral'], len(node['children']))
+
+    def get(self, path):
+        stat = self.exists(path)
+        if stat is None:
+            raise kazoo.exceptions.NoNodeError(path)
+        node = self.nodes[path]
+        data = node['data']
+        if data is not None:
+            data = data.encode('utf8')
+            if node.get('base64'):
+                data = base64.b64decode(data)
+        return data, stat
+
+    def get_children(self, path):
+        if path not in self.nodes:
+            raise kazoo.exceptions.NoNodeError(path)
+        return list(self.nodes[path]['children'])
+
+    def get_properties(self, path):
+        return decode(self.get(path)[0], path)
+
+# Mapped snapshot format:
+#
+#   header: magic, number of nodes, index offset, root path length
+#   root path
+#   for each node, in walk order: path, data
+#   index: fixed-size entries, sorted by (parent path, name)
+#
+# Because entries are sorted by parent path, the children of a node
+# are adjacent, so both nodes and their children can be looked up
+# with a binary search, without reading the rest of the file.
+_mapped_magic = 'zc.zk\x00M1'
+_mapped_header = struct.Struct('<8sQQI')
+# path offset, path length, data offset, data length (-1 for None),
+# version, ephemeral, number of children
+_mapped_entry = struct.Struct('<QIQiiBI')
+
+def _mapped_key(path):
+    if path == '/':
+        return '', ''
+    base, name = path.rsplit('/', 1)
+    return base or '/', name
+
+class MappedSnapshot(Resolving):
+    """Read-only, memory-mapped view of a tree saved with
+    ``ZooKeeper.save_snapshot(filename, path, mapped=True)``
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.index, root_len = (
+            _mapped_header.unpack_from(self.map, 0))
+        if magic != _mapped_magic:
+            raise ValueError("Not a mapped snapshot", filename)
+        start = _mapped_header.size
+        self.path = self.map[start:start+root_len].decode('utf8')
+
+    def close(self):
+        self.map.close()
+
+    def __len__(self):
+        return self.count
+
+    def _entry(self, i):
+        return _mapped_entry.unpack_from(
+            self.map, self.index + i * _mapped_entry.size)
+
+    def _key(self, i):
+        path_offset, path_len = self._entry(i)[:2]
+        return _mapped_key(self.map[path_offset:path_offset+path_len])
+
+    def _search(self, key):
+        # Index of the first entry with a key >= the given key.
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _find(self, path):
+        key = _mapped_key(path.encode('utf8'))
+        i = self._search(key)
+        if i < self.count and self._key(i) == key:
+            return self._entry(i)
+
+    def exists(self, path):
+        entry = self._find(path)
+        if entry is not None:
+            return SnapshotStat(entry[4], bool(entry[5]), entry[6])
+
+    def get(self, path):
+        entry = self._find(path)
+        if entry is None:
+            raise kazoo.exceptions.NoNodeError(path)
+        _, _, data_offset, data_len, version, ephemeral, nchildren = entry
+        if data_len < 0:
+            data = None
+        else:
+            data = self.map[data_offset:data_offset+data_len]
+        return data, SnapshotStat(version, bool(ephemeral), nchildren)
+
+    def get_children(self, path):
+        entry = self._find(path)
+        if entry is None:
+            raise kazoo.exceptions.NoNodeError(path)
+        path = path.encode('utf8')
+        i = self._search((path, ''))
+        children = []
+        for i in xrange(i, i + entry[6]):
+            base, name = self._key(i)
+            if base != path:
+                break
+            children.append(name.decode('utf8'))
+        return children
+
+    def get_properties(self, path):
+        return decode(self.get(path)[0], path)
+
+class ThreadPool:
+    """A pool of daemon threads for running watch callbacks
+
+    Pass it as the ``executor`` to ``children`` or ``properties``.
+    """
+
+    def __init__(self, size=4):
+        self.queue = Queue.Queue()
+        self.threads = [zc.thread.Thread(self._run) for i in range(size)]
+
+    def submit(self, func, *args, **kw):
+        self.queue.put((func, args, kw))
+
+    def _run(self):
+        while 1:
+            job = self.queue.get()
+            if job is None:
+                break
+            func, args, kw = job
+            try:
+                func(*args, **kw)
+            except Exception:
+                logger.exception("Error calling %r", func)
+
+    def shutdown(self, wait=True):
+        for thread in self.threads:
+            self.queue.put(None)
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
 class KazooWatch:
 
     def __init__(self, client, children, path, watch):
@@ -447,12 +1579,48 @@ class KazooWatch:
 class Watch:
     # Base class for child and data watchers
 
-    def __init__(self, zk, path, watch=True):
+    def __init__(self, zk, path, watch=True, executor=None):
         self.zk = zk
         self.path = path
         self.watch = watch
         self.callbacks = []
-        self.register(True)
+        self.executor = executor
+        if executor is not None:
+            # Notifications waiting for callbacks to be run by the
+            # executor, which runs them a notification at a time.
+            self._pending = collections.deque()
+            self._pending_lock = threading.Lock()
+            self._draining = False
+        self.metrics = dict(
+            notifications=0, calls=0, slow_calls=0,
+            callback_time=0.0, max_callback_time=0.0,
+            max_delay=0.0, max_lag=None,
+            )
+        if watch:
+            zk._watches.add(self)
+        if not (watch and zk.snapshot is not None and
+                self._register_from_snapshot()):
+            self.register(True)
+
+    _snapshot_data = None
+    def _register_from_snapshot(self):
+        # Start with data from the snapshot and let the ZooKeeper
+        # reconcile us with the server in the background.
+        snapshot = self.zk.snapshot
+        try:
+            real_path = snapshot.resolve(self.path)
+            if self.children:
+                data = snapshot.get_children(real_path)
+            else:
+                data = snapshot.get(real_path)[0]
+        except Exception:
+            return False
+
+        self.real_path = real_path
+        self._snapshot_data = data
+        self.setData(data)
+        self.zk._reconcile_later(self)
+        return True
 
     def register(self, reraise):
         try:
@@ -473,18 +1641,46 @@ class Watch:
                     self.setData(self.zk.get(real_path)[0])
 
     def handle(self, data, *rest):
+        received = time.time()
         if data is None:
             # The watched node was deleted.
             # Try to re-resolve the watch path.
             self.register(False)
         else:
-            self._notify(data)
+            mtime = getattr(rest and rest[0], 'mtime', None)
+            if mtime:
+                # Time since the server modified the node, subject to
+                # clock skew.
+                lag = received - mtime / 1000.0
+                max_lag = self.metrics['max_lag']
+                if max_lag is None or lag > max_lag:
+                    self.metrics['max_lag'] = lag
+            snapshot_data = self._snapshot_data
+            if snapshot_data is not None:
+                # First data from the server after starting from a
+                # snapshot. Only notify if they're different.
+                self._snapshot_data = None
+                if self.children:
+                    if sorted(snapshot_data) == sorted(data):
+                        return
+                elif snapshot_data == data:
+                    return
+            self._notify(data, received)
 
     def setData(self, data):
         self.data = data
 
     deleted = False
     def _deleted(self):
+        # The node was deleted and the path couldn't be re-resolved.
+        # With an executor, callbacks for earlier notifications are
+        # run first.
+        if self.executor is None:
+            self._set_deleted()
+        else:
+            self._queue(self._set_deleted)
+
+    def _set_deleted(self):
         self.deleted = True
         self.data = {}
         for callback in self.callbacks:
@@ -501,10 +1697,42 @@ class Watch:
             self.__class__.__module__, self.__class__.__name__,
             self.path)
 
-    def _notify(self, data):
+    def _notify(self, data, received=None):
+        if received is None:
+            received = time.time()
+        self.metrics['notifications'] += 1
         if data is not None:
             self.setData(data)
-        for callback in list(self.callbacks):
+        callbacks = list(self.callbacks)
+        if self.executor is None:
+            self._call_callbacks(callbacks, received)
+        elif callbacks:
+            self._queue(self._call_callbacks, callbacks, received)
+
+    def _queue(self, func, *args):
+        with self._pending_lock:
+            self._pending.append((func, args))
+            if self._draining:
+                return
+            self._draining = True
+        self.executor.submit(self._drain)
+
+    def _drain(self):
+        # Run callbacks for pending notifications, in order.  Only one
+        # drain runs for a watch at a time.
+        while 1:
+            with self._pending_lock:
+                if not self._pending:
+                    self._draining = False
+                    return
+                func, args = self._pending.popleft()
+            func(*args)
+
+    def _call_callbacks(self, callbacks, received):
+        for callback in callbacks:
+            if callback not in self.callbacks:
+                continue # Cancelled
+            start = time.time()
             try:
                 callback(self)
             except Exception, v:
@@ -513,6 +1741,21 @@ class Watch:
                     logger.debug("cancelled watch(%r, %r)", self, callback)
                 else:
                     logger.exception("watch(%r, %r)", self, callback)
+            self._record_call(callback, received, start, time.time())
+
+    def _record_call(self, callback, received, start, end):
+        metrics = self.metrics
+        elapsed = end - start
+        metrics['calls'] += 1
+        metrics['callback_time'] += elapsed
+        metrics['max_callback_time'] = max(
+            metrics['max_callback_time'], elapsed)
+        metrics['max_delay'] = max(metrics['max_delay'], start - received)
+        threshold = self.zk.slow_callback_threshold
+        if threshold is not None and elapsed > threshold:
+            metrics['slow_calls'] += 1
+            logger.warning("Slow callback %r for %r took %.3f seconds",
+                           callback, self, elapsed)
 
     def __call__(self, func):
         if not self.watch:
@@ -534,16 +1777,144 @@ class Children(Watch):
     def __len__(self):
         return len(self.data)
 
+def sequence_number(name):
+    """Return the sequence number of a sequence node name, or None
+    """
+    suffix = name[-10:]
+    if len(suffix) == 10 and suffix.isdigit():
+        return int(suffix)
+
+class SequenceChildren(Children):
+    """Children of a node with sequence nodes, kept in sequence order
+
+    Sequence numbers are parsed once per child and children are kept
+    sorted, with changes applied incrementally, so looking up the
+    first children, or the children after a given child, is cheap
+    even for nodes with very many children, as used by queues and
+    locks.  Children without sequence-number suffixes are ignored.
+    """
+
+    added = removed = ()
+    _sequences = None
+    _sorted = [], [] # Never changed in place
+
+    def setData(self, data):
+        # A notification has the complete list of children, so we
+        # find what changed and update sorted lists of sequence
+        # numbers and names to match.  Only new names are parsed and
+        # encoded.  New lists are assigned, so readers in other
+        # threads see consistent data.
+        names = set(data)
+        sequences = self._sequences # {name: (number, encoded name)}
+        if sequences is None:
+            sequences = self._sequences = {}
+            old = set()
+            keys, sorted_names = [], []
+        else:
+            old = self._names
+            keys, sorted_names = self._sorted
+        added = []
+        for name in names - old:
+            number = sequence_number(name)
+            if number is not None:
+                item = number, name.encode('utf8')
+                sequences[name] = item
+                added.append(item)
+        added.sort()
+        removed = sorted(sequences.pop(name)
+                         for name in old - names if name in sequences)
+
+        if len(added) + len(removed) > len(keys) // 4:
+            # Lots of changes (or the first data), just sort.
+            items = sorted(sequences.itervalues())
+            keys = [entry[0] for entry in items]
+            sorted_names = [entry[1] for entry in items]
+        else:
+            keys = list(keys)
+            sorted_names = list(sorted_names)
+            for number, name in removed:
+                i = bisect.bisect_left(keys, number)
+                del keys[i]
+                del sorted_names[i]
+            for number, name in added:
+                i = bisect.bisect_left(keys, number)
+                keys.insert(i, number)
+                sorted_names.insert(i, name)
+
+        self._names = names
+        self._sorted = keys, sorted_names
+        self.added = [name for number, name in added]
+        self.removed = [name for number, name in removed]
+        Watch.setData(self, sorted_names)
+
+    def __contains__(self, child):
+        return child in (self._sequences or ())
+
+    def _set_deleted(self):
+        self._sequences = None
+        self._sorted = [], []
+        Children._set_deleted(self)
+
+    def _key(self, child):
+        if isinstance(child, basestring):
+            number = sequence_number(child)
+            if number is None:
+                raise ValueError("Not a sequence node name", child)
+            return number
+        return child
+
+    def min(self):
+        """Return the child with the lowest sequence number, or None
+        """
+        names = self._sorted[1]
+        if names:
+            return names[0]
+
+    def next(self, child):
+        """Return the first child after the given child, or None
+
+        The child can be given as a name or sequence number, and
+        needn't exist.
+        """
+        keys, names = self._sorted
+        i = bisect.bisect_right(keys, self._key(child))
+        if i < len(names):
+            return names[i]
+
+    def previous(self, child):
+        """Return the last child before the given child, or None
+
+        The child can be given as a name or sequence number, and
+        needn't exist.
+        """
+        keys, names = self._sorted
+        i = bisect.bisect_left(keys, self._key(child))
+        if i:
+            return names[i - 1]
+
+    def range(self, start=None, stop=None):
+        """Return children from start up to, but not including, stop
+
+        Children can be given as names or sequence numbers.
+        """
+        keys, names = self._sorted
+        i = (0 if start is None
+             else bisect.bisect_left(keys, self._key(start)))
+        j = (len(keys) if stop is None
+             else bisect.bisect_left(keys, self._key(stop)))
+        return names[i:j]
+
 class Properties(Watch, collections.Mapping):
 
     children = False
 
-    def __init__(self, zk, path, watch=True, _linked_properties=None):
+    def __init__(self, zk, path, watch=True, _linked_properties=None,
+                 executor=None):
         if _linked_properties is None:
              # {prop_link_path -> Properties}
             _linked_properties = {}
         self._linked_properties = _linked_properties
-        Watch.__init__(self, zk, path, watch)
+        Watch.__init__(self, zk, path, watch, executor)
 
     def _setData(self, data, handle_errors=False):
         # Save a mapping as our data.
@@ -563,7 +1934,7 @@ class Properties(Watch, collections.Mapping):
 
                         # TODO: why resolve here? Why not store the original
                         # path in the linked properties.
-                        path = self.zk.resolve(path)
+                        path = self._resolve(path)
                         properties = self._setup_link(path)
                         properties[link and link[0] or name[:-3]]
                     except Exception, v:
@@ -577,6 +1948,13 @@ class Properties(Watch, collections.Mapping):
             self.data = old # rollback
             raise
 
+    def _resolve(self, path):
+        # Until we've heard from the server, we were initialized from
+        # a snapshot, so resolve links the same way.
+        if self._snapshot_data is not None:
+            return self.zk.snapshot.resolve(path)
+        return self.zk.resolve(path)
+
     def _setup_link(self, path):
         _linked_properties = self._linked_properties
         props = _linked_properties.get(path)
@@ -624,7 +2002,7 @@ class Properties(Watch, collections.Mapping):
                 if not path[0] == '/':
                     path = self.path + '/' + path
 
-                path = self.zk.resolve(path)
+                path = self._resolve(path)
                 if path in seen:
                     raise LinkLoop(seen+(path,))
                 seen += (path,)
@@ -815,3 +2193,24 @@ class RegisteringServer:
     def __repr__(self):
         return "RegisteringServer(%r, %r, %r)" % (
             self.name, self.path, self.properties)
+
+class UnregisteringServer:
+    """Event emitted when a registered server's nodes go away.
+
+    This happens when the ephemeral nodes created by ``register`` are
+    deleted with ``delete`` or when the ``ZooKeeper`` object is closed.
+
+    Attributes:
+
+    name
+      The server name, as passed to ``register``
+    path
+      The service path (node parent path)
+    """
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+
+    def __repr__(self):
+        return "UnregisteringServer(%r, %r)" % (self.name, self.path)
@@ -0,0 +1,303 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmarks for zc.zk
+
+Run with::
+
+  python -m zc.zk.bench [options] [benchmark ...]
+
+Results are written as JSON, so they can be compared across versions.
+Benchmarks are run against the zc.zk.testing mock server or, with
+``--backend server``, against a local ``zc.zk.server`` server.  The
+testing dependencies (mock, zope.testing) must be installed.
+"""
+import json
+import optparse
+import platform
+import sys
+import threading
+import time
+import zc.zk
+import zc.zk.testing
+
+benchmarks = []
+
+def benchmark(func):
+    benchmarks.append(func)
+    return func
+
+class Backend:
+    """Creates ZooKeeper objects connected to a fresh server
+    """
+
+    def __init__(self, name='mock', latency=0):
+        self.name = name
+        if name == 'mock':
+            self.server = zc.zk.testing.ZooKeeper(
+                'bench:2181', zc.zk.testing.Node())
+            self.connection_string = 'bench:2181'
+        elif name == 'server':
+            self.server = zc.zk.testing.start_server('', latency)
+            self.connection_string = self.server.connection_string
+        else:
+            raise ValueError("Unknown backend", name)
+        self.zks = []
+
+    def zk(self):
+        if self.name == 'mock':
+            client = zc.zk.testing.Client(self.server, self.connection_string)
+            client.start()
+            zk = zc.zk.ZooKeeper(client)
+        else:
+            zk = zc.zk.ZooKeeper(self.connection_string)
+        self.zks.append(zk)
+        return zk
+
+    def lose_session(self, zk):
+        if self.name == 'mock':
+            zk.client.lose_session()
+        else:
+            self.server.expire(zk.client._session_id)
+
+    def close(self):
+        for zk in self.zks:
+            zk.close()
+            if self.name == 'mock':
+                zk.client.stop()
+        if self.name == 'server':
+            self.server.stop()
+
+def timeit(func, repeat):
+    # Return the best time for calling func.
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def tree_text(size, **options):
+    """Return import text for a generated tree with about ``size`` nodes.
+    """
+    # Trees are 3 levels deep.  Choose the fanout that comes closest.
+    fanout = max(1, int(round(size ** (1.0 / 3))))
+    options.setdefault('properties', 4)
+    options.setdefault('property_size', 16)
+    options.setdefault('link_density', .1)
+    return zc.zk.testing.TreeGenerator(
+        fanout=fanout, depth=3, **options).text()
+
+def wait(func, timeout=60):
+    deadline = time.time() + timeout
+    while not func():
+        if time.time() > deadline:
+            raise AssertionError("Timed out")
+        time.sleep(.001)
+
+@benchmark
+def parse_tree(backend, size, repeat):
+    text = tree_text(size)
+    return dict(parse_tree=timeit(lambda : zc.zk.parse_tree(text), repeat))
+
+@benchmark
+def encode_decode(backend, size, repeat):
+    properties = dict(database='/databases/foomain', threads=4,
+                      favorite_color='red', weights=[1, 2, 3], debug=False)
+    data = zc.zk.encode(properties)
+    def encode():
+        for i in xrange(size):
+            zc.zk.encode(properties)
+    def decode():
+        for i in xrange(size):
+            zc.zk.decode(data)
+    return dict(encode=timeit(encode, repeat), decode=timeit(decode, repeat))
+
+@benchmark
+def resolve(backend, size, repeat, depth=10):
+    # Resolve a path through a chain of symbolic links.
+    zk = backend.zk()
+    zk.import_tree('/chain\n  /target\n')
+    links = dict(('l%s ->' % i, 'l%s' % (i + 1)) for i in range(depth))
+    links['l%s ->' % depth] = 'target'
+    zk.properties('/chain', False).set(links)
+    assert zk.resolve('/chain/l0') == '/chain/target'
+    def resolve():
+        for i in xrange(size):
+            zk.resolve('/chain/l0')
+    return dict(resolve=timeit(resolve, repeat))
+
+@benchmark
+def property_links(backend, size, repeat):
+    # Look up properties through chains of property links, in a tree
+    # with a chain for every 10 nodes.
+    zk = backend.zk()
+    zk.create('/tree')
+    zk.import_tree(tree_text(size, property_links=size // 10), '/tree')
+    properties = [zk.properties(path, False) for path in zk.walk('/tree')]
+    names = [(p, name[:-3]) for p in properties for name in p.data
+             if name.endswith(' =>')]
+    def lookup():
+        for p, name in names:
+            p[name]
+    return dict(property_links=timeit(lookup, repeat))
+
+@benchmark
+def trees(backend, size, repeat):
+    # import_tree, export_tree and delete_recursive of a generated tree
+    zk = backend.zk()
+    text = tree_text(size)
+    results = dict(import_tree=[], export_tree=[], delete_recursive=[])
+    for i in range(repeat):
+        zk.create('/tree')
+        start = time.time()
+        zk.import_tree(text, '/tree')
+        results['import_tree'].append(time.time() - start)
+        start = time.time()
+        zk.export_tree('/tree')
+        results['export_tree'].append(time.time() - start)
+        start = time.time()
+        zk.delete_recursive('/tree')
+        results['delete_recursive'].append(time.time() - start)
+    return dict((name, min(times)) for (name, times) in results.items())
+
+@benchmark
+def watch_fanout(backend, size, repeat):
+    # Time from a change to the delivery of notifications to
+    # ``size`` watches on the changed node, spread over a few sessions.
+    zks = [backend.zk() for i in range(4)]
+    zks[0].create('/watched', zc.zk.encode(dict(n=0)))
+    counts = [0]
+    lock = threading.Lock()
+    def callback(properties):
+        with lock:
+            counts[0] += 1
+    watches = [zks[i % len(zks)].properties('/watched') for i in range(size)]
+    for properties in watches:
+        properties(callback)
+    times = []
+    for i in range(repeat):
+        counts[0] = 0
+        start = time.time()
+        zks[0].properties('/watched', False).set(n=i+1)
+        wait(lambda : counts[0] >= size)
+        times.append(time.time() - start)
+    return dict(watch_fanout=min(times))
+
+@benchmark
+def ephemeral_restore(backend, size, repeat):
+    # Time for ephemeral nodes to be recreated after session expiration
+    zk = backend.zk()
+    zk.create('/providers')
+    for i in range(size):
+        zk.register('/providers', 'h%s:%s' % (i // 1000, i % 1000))
+    times = []
+    for i in range(repeat):
+        last = zk.last_restore
+        start = time.time()
+        backend.lose_session(zk)
+        wait(lambda : zk.last_restore is not last and
+             len(zk.get_children('/providers')) == size)
+        times.append(time.time() - start)
+    return dict(ephemeral_restore=min(times),
+                ephemeral_restore_duration=zk.last_restore['duration'])
+
+@benchmark
+def work_queue(backend, size, repeat, batch=100):
+    # Add ``size`` items to a work queue, in batches, and claim them.
+    zk = backend.zk()
+    results = dict(work_queue_put=[], work_queue_get=[])
+    for i in range(repeat):
+        queue = zc.zk.WorkQueue(zk, '/queue%s' % i, batch)
+        values = ['item %s' % n for n in xrange(size)]
+        start = time.time()
+        for n in xrange(0, size, batch):
+            queue.put_all(values[n:n+batch])
+        results['work_queue_put'].append(time.time() - start)
+        start = time.time()
+        claimed = 0
+        while claimed < size:
+            claimed += len(queue.get(60))
+        results['work_queue_get'].append(time.time() - start)
+        queue.close()
+    return dict((name, min(times)) for (name, times) in results.items())
+
+def run(names=None, sizes=(1000, ), repeat=3, backend='mock', latency=0):
+    """Run benchmarks, returning results suitable for JSON
+    """
+    results = []
+    for func in benchmarks:
+        if names and func.__name__ not in names:
+            continue
+        for size in sizes:
+            b = Backend(backend, latency)
+            try:
+                measurements = func(b, size, repeat)
+            finally:
+                b.close()
+            results.append(dict(benchmark=func.__name__, size=size,
+                                seconds=measurements))
+    try:
+        import pkg_resources
+        version = pkg_resources.get_distribution('zc.zk').version
+    except Exception:
+        version = None
+    return dict(version=version, python=platform.python_version(),
+                backend=backend, latency=latency, repeat=repeat,
+                time=time.time(), results=results)
+
+def main(args=None):
+    """Usage: %prog [options] [benchmark ...]
+
+    Run zc.zk benchmarks, writing results as JSON.
+    """
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = optparse.OptionParser(main.__doc__)
+    parser.add_option('-s', '--sizes', default='1000',
+                      help='Comma-separated problem sizes (default 1000)')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='Times to repeat each measurement (default 3)')
+    parser.add_option('-b', '--backend', default='mock',
+                      help="'mock' (default) or 'server'")
+    parser.add_option('-l', '--latency', type='float', default=0,
+                      help='Server response latency, in seconds')
+    parser.add_option('-o', '--output', help='Output file')
+    parser.add_option('--list', action='store_true',
+                      help='List the available benchmarks')
+
+    options, names = parser.parse_args(args)
+    if options.list:
+        for func in benchmarks:
+            print func.__name__
+        return
+
+    unknown = set(names) - set(func.__name__ for func in benchmarks)
+    if unknown:
+        parser.error("Unknown benchmarks: %s" % ' '.join(sorted(unknown)))
+
+    results = run(names, [int(size) for size in options.sizes.split(',')],
+                  options.repeat, options.backend, options.latency)
+    data = json.dumps(results, sort_keys=True, indent=1,
+                      separators=(',', ': '))
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        print data
+
+if __name__ == '__main__':
+    main()
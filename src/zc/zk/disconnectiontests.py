@@ -68,6 +68,48 @@ def wait_for_zookeeper():
     >>> zk.close()
     """
 
+def start_from_snapshot_without_zookeeper():
+    """
+    If we have a snapshot, we can start without ZooKeeper:
+
+    >>> import os, shutil, tempfile
+    >>> tmp = tempfile.mkdtemp()
+    >>> filename = os.path.join(tmp, 'snapshot')
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zk.save_snapshot(filename)
+    >>> zk.close()
+
+    >>> handler = zope.testing.loggingsupport.InstalledHandler('zc.zk')
+    >>> zk = zc.zk.ZooKeeper('Invalid', snapshot=filename)
+    >>> print handler
+    zc.zk CRITICAL
+      Can't connect to ZooKeeper at 'Invalid'
+    >>> handler.uninstall()
+
+    >>> properties = zk.properties('/fooservice')
+    >>> @properties
+    ... def changed(properties):
+    ...     print 'threads', properties['threads']
+    threads 1
+    >>> sorted(zk.children('/fooservice'))
+    ['providers']
+
+    When ZooKeeper becomes available, we connect and reconcile:
+
+    >>> ZooKeeper._allow_connection('Invalid')
+    >>> wait(lambda : zk.state == 'CONNECTED')
+    >>> wait(lambda : not zk._unreconciled)
+    >>> zk.properties('/fooservice').update(threads=3)
+    threads 3
+
+    >>> import threading
+    >>> wait(lambda : 'zc.zk.connect' not in
+    ...      [t.name for t in threading.enumerate()])
+
+    >>> zk.close()
+    >>> shutil.rmtree(tmp)
+    """
+
 def log_ephemeral_restoration_on_session_timeout():
     """
     >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
@@ -93,6 +135,28 @@ def log_ephemeral_restoration_on_session_timeout():
     >>> zk.close()
     """
 
+def status_records_session_history_and_restoration():
+    """
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zk.register('/fooservice/providers', 'test')
+    >>> [state for (t, state) in zk.status()['session_history']]
+    ['CONNECTED']
+    >>> zk.status()['last_restore']
+
+    >>> zk.client.lose_session()
+    >>> from zope.testing.wait import wait
+    >>> wait(lambda : zk.last_restore is not None)
+    >>> status = zk.status()
+    >>> [state for (t, state) in status['session_history']]
+    ['CONNECTED', 'SUSPENDED', 'LOST', 'CONNECTED']
+    >>> status['last_restore']['nodes'], status['last_restore']['duration'] < 1
+    (1, True)
+    >>> status['ephemeral']
+    ['/fooservice/providers/test']
+
+    >>> zk.close()
+    """
+
 def session_timeout_with_child_and_data_watchers():
     """
 
@@ -12,27 +12,145 @@
 #
 ##############################################################################
 
+import collections
 import json
 import logging
+import optparse
+import socket
 import sys
+import threading
+import time
+import zc.thread
+import zc.zk
 
 logger = logging.getLogger(__name__)
 
-_servers = []
+# Registered servers: {path -> {address -> server}}
+_servers = collections.OrderedDict()
 
 def notify(event):
-    _servers.append(dict(address=event.name, path=event.path,
-                         **event.properties))
+    # Registering the same address again replaces the old entry.
+    _servers.setdefault(event.path, collections.OrderedDict())[event.name] = (
+        dict(address=event.name, path=event.path, **event.properties))
+
+def unregister(event):
+    addresses = _servers.get(event.path)
+    if addresses is not None:
+        addresses.pop(event.name, None)
+        if not addresses:
+            del _servers[event.path]
 
 def servers(connection, path=None):
     if path is None:
-        connection.write(json.dumps(_servers) + '\n')
+        connection.write(json.dumps(
+            [server for addresses in _servers.values()
+             for server in addresses.values()]) + '\n')
     else:
-        connection.write(
-            ' '.join([s['address'] for s in _servers if s['path'] == path])
-             + '\n')
+        connection.write(' '.join(_servers.get(path, ())) + '\n')
+
+def stats(connection, name=None):
+    connection.write(json.dumps(
+        [i.stats() for i in list(zc.zk._instrumentations)
+         if name is None or i.name == name],
+        sort_keys=True) + '\n')
+
+def zookeeper(connection, connection_string=None):
+    connection.write(json.dumps(
+        [zk.status() for zk in list(zc.zk._zookeepers)
+         if connection_string is None or
+         zk.connection_string == connection_string],
+        sort_keys=True) + '\n')
+
+def _labels(**labels):
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in sorted(labels.items()))
+
+def _float(value):
+    return repr(float(value))
+
+def prometheus_text():
+    """Return zc.zk metrics in the Prometheus text exposition format
+
+    Metrics are computed from counters kept as operations and
+    notifications happen, so the cost is proportional to the number
+    of metrics, not to the size of trees or numbers of watches.
+    """
+    families = [
+        ('zczk_operations_total', 'counter',
+         'ZooKeeper operations performed'),
+        ('zczk_operation_errors_total', 'counter',
+         'ZooKeeper operations that failed, by error'),
+        ('zczk_operation_duration_seconds', 'histogram',
+         'ZooKeeper operation latency'),
+        ('zczk_watches', 'gauge', 'Children and Properties objects in use'),
+        ('zczk_ephemeral_nodes', 'gauge', 'Ephemeral nodes registered'),
+        ('zczk_session_state', 'gauge', 'Current ZooKeeper session state'),
+        ]
+    samples = dict((name, []) for name, _, _ in families)
+
+    # ZooKeeper objects with the same connection string, like the
+    # sessions of a pool, are told apart with a session label,
+    # numbering them in the order they were created.
+    sessions = collections.defaultdict(int)
+    instrumentations = set()
+    for zk in sorted(zc.zk._zookeepers, key=lambda zk: zk._number):
+        connection = zk.connection_string or ''
+        labels = dict(connection=connection, session=sessions[connection])
+        sessions[connection] += 1
+        samples['zczk_watches'].append(
+            ('', _labels(**labels), len(zk._watches)))
+        samples['zczk_ephemeral_nodes'].append(
+            ('', _labels(**labels), len(zk.ephemeral)))
+        for state in 'CONNECTED', 'SUSPENDED', 'LOST':
+            samples['zczk_session_state'].append(
+                ('', _labels(state=state, **labels),
+                 int(zk.state == state)))
+
+        # An instrumentation shared by several ZooKeeper objects is
+        # reported once, with the first of them.
+        if (zk.instrumentation is None or
+            zk.instrumentation in instrumentations):
+            continue
+        instrumentations.add(zk.instrumentation)
+        stats = zk.instrumentation.operation_stats()
+        buckets = stats['buckets']
+        for op, data in sorted(stats['operations'].items()):
+            samples['zczk_operations_total'].append(
+                ('', _labels(operation=op, **labels), data['count']))
+            for error, count in sorted(data['errors'].items()):
+                samples['zczk_operation_errors_total'].append(
+                    ('', _labels(operation=op, error=error, **labels),
+                     count))
+            histogram = samples['zczk_operation_duration_seconds']
+            total = 0
+            for bound, count in zip(buckets + ['+Inf'], data['histogram']):
+                total += count
+                if bound != '+Inf':
+                    bound = _float(bound)
+                histogram.append(
+                    ('_bucket', _labels(operation=op, le=bound, **labels),
+                     total))
+            histogram.append(
+                ('_sum', _labels(operation=op, **labels), data['time']))
+            histogram.append(
+                ('_count', _labels(operation=op, **labels), data['count']))
+
+    lines = []
+    for name, kind, doc in families:
+        lines.append('# HELP %s %s\n' % (name, doc))
+        lines.append('# TYPE %s %s\n' % (name, kind))
+        for suffix, labels, value in samples[name]:
+            if isinstance(value, float):
+                value = _float(value)
+            lines.append('%s%s%s %s\n' % (name, suffix, labels, value))
+    return ''.join(lines)
 
-def _connect(addr):
+def prometheus(connection):
+    connection.write(prometheus_text())
+
+def _connect(addr, timeout=None):
     import re
     import socket
 
@@ -43,7 +161,13 @@ def _connect(addr):
     else:
         sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 
-    sock.connect(addr)
+    if timeout is not None:
+        sock.settimeout(timeout)
+    try:
+        sock.connect(addr)
+    except:
+        sock.close()
+        raise
     return sock
 
 def check(args=None):
@@ -78,3 +202,172 @@ def get_addr(args=None):
     f = sock.makefile()
     sock.sendall('servers %s\n' % path)
     print f.readline(),
+
+class Probe:
+    """Check servers registered with monitors, reusing connections
+
+    Connections to monitors are kept open, using the monitor's
+    interactive mode, if it's available, so that many paths can be
+    looked up without reconnecting.  Connections to the servers found
+    are made concurrently and timed.
+    """
+
+    def __init__(self, timeout=5.0, concurrency=8):
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self._lock = threading.Lock()
+        # {monitor address -> (socket, file)}, or None if the monitor
+        # doesn't support interactive mode
+        self._monitors = {}
+
+    def _monitor(self, monitor):
+        try:
+            return self._monitors[monitor]
+        except KeyError:
+            pass
+        sock = _connect(monitor, self.timeout)
+        f = sock.makefile()
+        sock.sendall('interactive\n')
+        if f.readline().startswith('Interactive'):
+            connection = sock, f
+        else:
+            f.close()
+            sock.close()
+            connection = None
+        self._monitors[monitor] = connection
+        return connection
+
+    def _close_monitor(self, monitor):
+        connection = self._monitors.pop(monitor, None)
+        if connection is not None:
+            sock, f = connection
+            f.close()
+            sock.close()
+
+    def lookup(self, monitor, path):
+        """Return the address registered for a path, or an empty string
+        """
+        with self._lock:
+            for retry in (False, True):
+                connection = self._monitor(monitor)
+                if connection is None:
+                    sock = _connect(monitor, self.timeout)
+                    try:
+                        sock.sendall('servers %s\n' % path)
+                        return sock.makefile().readline().strip()
+                    finally:
+                        sock.close()
+                sock, f = connection
+                try:
+                    sock.sendall('servers %s\n' % path)
+                    line = f.readline()
+                    if not line:
+                        raise socket.error("Monitor connection closed")
+                    return line.strip()
+                except socket.error:
+                    # The connection may have gone stale. Reconnect once.
+                    self._close_monitor(monitor)
+                    if retry:
+                        raise
+
+    def check(self, monitor, paths):
+        """Check the servers registered for the given paths
+
+        A dictionary is returned mapping paths to dictionaries with
+        the server ``address``, the ``latency`` of connecting to it,
+        in seconds, and an ``error`` message, which is None if the
+        check succeeded.
+        """
+        results = {}
+        for path in paths:
+            result = results[path] = dict(
+                address=None, latency=None, error=None)
+            try:
+                result['address'] = self.lookup(monitor, path)
+            except Exception, v:
+                result['error'] = str(v) or v.__class__.__name__
+            else:
+                if not result['address']:
+                    result['error'] = 'No server'
+
+        def connect(result):
+            start = time.time()
+            try:
+                _connect(result['address'], self.timeout).close()
+            except Exception, v:
+                result['error'] = str(v) or v.__class__.__name__
+            else:
+                result['latency'] = time.time() - start
+
+        todo = [checked for checked in results.values()
+                if checked['error'] is None]
+        for i in xrange(0, len(todo), self.concurrency):
+            threads = [zc.thread.Thread(connect, args=(checked,))
+                       for checked in todo[i:i+self.concurrency]]
+            for thread in threads:
+                thread.join()
+
+        return results
+
+    def close(self):
+        with self._lock:
+            for monitor in list(self._monitors):
+                self._close_monitor(monitor)
+
+def probe(args=None):
+    """Usage: %prog [options] monitor-address path ...
+
+    Check the servers registered for the given paths with a monitor,
+    printing each path, server address and connection time in
+    milliseconds or an error.
+
+    With the interval option, checks are repeated, reusing the
+    connection to the monitor.  The exit status is non-zero if any
+    check in the last round failed.
+    """
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = optparse.OptionParser(probe.__doc__)
+    parser.add_option('-i', '--interval', type='float',
+                      help='Seconds between rounds of checks')
+    parser.add_option('-n', '--count', type='int',
+                      help='Number of rounds of checks (default: 1, or'
+                      ' forever, with an interval)')
+    parser.add_option('-t', '--timeout', type='float', default=5.0)
+    parser.add_option('-c', '--concurrency', type='int', default=8)
+
+    options, args = parser.parse_args(args)
+    if len(args) < 2:
+        parser.parse_args(['-h'])
+    monitor = args.pop(0)
+
+    count = options.count
+    if count is None and not options.interval:
+        count = 1
+
+    prober = Probe(options.timeout, options.concurrency)
+    try:
+        while 1:
+            results = prober.check(monitor, args)
+            failed = False
+            for path in args:
+                result = results[path]
+                if result['error'] is None:
+                    print path, result['address'], '%.3fms' % (
+                        result['latency'] * 1000)
+                else:
+                    failed = True
+                    print path, result['address'] or '-', result['error']
+            sys.stdout.flush()
+            if count is not None:
+                count -= 1
+                if count <= 0:
+                    break
+            if options.interval:
+                time.sleep(options.interval)
+    finally:
+        prober.close()
+
+    if failed:
+        sys.exit(1)
@@ -104,6 +104,58 @@ def import_(args=None):
 
     zk.close()
 
+def diff(args=None):
+    """Usage: %prog [options] connection [tree-file [path]]
+
+    Show the differences between a tree definition in a file and a
+    ZooKeeper tree.
+
+    If no tree-file is provided or if the tree file is -, then data
+    are read from standard input.
+    """
+
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = optparse.OptionParser(diff.__doc__)
+    parser.add_option('-t', '--trim', action='store_true')
+    parser.add_option(
+        '-p', '--permission', type='int',
+        default=kazoo.security.Permissions.ALL,
+        help='ZooKeeper permission bits as integer,'
+        ' kazoo.security.Permissions.ALL',
+        )
+
+    options, args = parser.parse_args(args)
+    if not (1 <= len(args) <= 3):
+        parser.parse_args(['-h'])
+
+    connection = args.pop(0)
+    if args:
+        tree_file = args.pop(0)
+    else:
+        tree_file = '-'
+
+    if args:
+        [path] = args
+    else:
+        path = '/'
+
+    logging.basicConfig(level=logging.WARNING)
+
+    zk = zc.zk.ZooKeeper(connection)
+    if tree_file == '-':
+        tree_file = sys.stdin
+    else:
+        tree_file = open(tree_file)
+
+    for change in zk.diff_tree(tree_file.read(), path, trim=options.trim,
+                               acl=[world_acl(options.permission)]):
+        for line in change.describe():
+            print line
+
+    zk.close()
+
 def validate_(args=None):
     """Usage: %prog connection [file [path]]
 
@@ -0,0 +1,616 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.0 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""A small in-memory ZooKeeper server for tests and benchmarks
+
+It speaks enough of the ZooKeeper wire protocol for kazoo (and so
+zc.zk) to create, read, update and delete nodes, watch them and run
+transactions, over real sockets, with optional added latency.  It
+doesn't do replication, persistence, authentication or ACL checks.
+"""
+import collections
+import kazoo.exceptions
+import logging
+import os
+import re
+import socket
+import struct
+import threading
+import time
+import zc.thread
+
+from kazoo.protocol.serialization import (
+    int_struct, multiheader_struct, read_acl, read_buffer,
+    read_string, reply_header_struct, stat_struct, write_buffer,
+    write_string)
+
+logger = logging.getLogger(__name__)
+
+connect_request_struct = struct.Struct('!iqiq')
+connect_response_struct = struct.Struct('!iiq')
+request_header_struct = struct.Struct('!ii')
+watch_event_struct = struct.Struct('!ii')
+
+WATCH_XID = -1
+PING_XID = -2
+AUTH_XID = -4
+
+CREATED_EVENT = 1
+DELETED_EVENT = 2
+CHANGED_EVENT = 3
+CHILD_EVENT = 4
+CONNECTED_STATE = 3
+
+EPHEMERAL = 1
+SEQUENCE = 2
+
+badpath = re.compile(r'(^|/)\.\.?(/|$)|//').search
+
+class Error(Exception):
+
+    def __init__(self, exception_class):
+        self.code = exception_class.code
+
+class Node:
+
+    def __init__(self, data, acl, zxid, ephemeral_owner=0):
+        self.data = data
+        self.acl = acl
+        self.children = set()
+        self.czxid = self.mzxid = self.pzxid = zxid
+        self.ctime = self.mtime = int(time.time() * 1000)
+        self.version = self.cversion = self.aversion = 0
+        self.ephemeral_owner = ephemeral_owner
+
+    def stat(self):
+        return stat_struct.pack(
+            self.czxid, self.mzxid, self.ctime, self.mtime, self.version,
+            self.cversion, self.aversion, self.ephemeral_owner,
+            len(self.data or ''), len(self.children), self.pzxid)
+
+class Session:
+
+    connection = None
+    expiration = None
+
+    def __init__(self, id, timeout):
+        self.id = id
+        self.timeout = timeout
+        self.passwd = os.urandom(16)
+        self.ephemeral = set()
+
+class Server:
+    """A ZooKeeper server listening on a local address
+
+    latency
+       Seconds to delay each response and watch event by, or a
+       function, called without arguments, that returns the delay.
+       Responses are sent in order, but requests don't wait for earlier
+       responses to be delivered, so pipelined requests overlap as
+       they would on a network.
+    """
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0):
+        self.latency = latency
+        self.lock = threading.RLock()
+        self.zxid = 0
+        self.nodes = {'/': Node('', (), 0)}
+        self.data_watches = collections.defaultdict(set)
+        self.child_watches = collections.defaultdict(set)
+        self.sessions = {}
+        self.last_session_id = 0
+        self.connections = set()
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(address)
+        self.socket.listen(64)
+        self.address = self.socket.getsockname()
+        self.connection_string = '%s:%s' % self.address
+        self.stopped = False
+        self.thread = zc.thread.Thread(self._accept)
+
+    def _accept(self):
+        while not self.stopped:
+            try:
+                sock, addr = self.socket.accept()
+            except socket.error:
+                if self.stopped:
+                    break
+                raise
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                self.connections.add(Connection(self, sock))
+
+    def stop(self):
+        self.stopped = True
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
+        self.thread.join(9)
+        with self.lock:
+            for connection in list(self.connections):
+                connection.close()
+            for session in self.sessions.values():
+                if session.expiration is not None:
+                    session.expiration.cancel()
+
+    def delay(self):
+        latency = self.latency
+        return latency() if callable(latency) else latency
+
+    # Sessions
+
+    def connect(self, connection, session_id, passwd, timeout):
+        with self.lock:
+            if session_id:
+                session = self.sessions.get(session_id)
+                if session is None or session.passwd != passwd:
+                    return None
+                if session.expiration is not None:
+                    session.expiration.cancel()
+                    session.expiration = None
+                if session.connection is not None:
+                    session.connection.close()
+            else:
+                self.last_session_id += 1
+                session = Session(self.last_session_id, timeout)
+                self.sessions[session.id] = session
+            session.connection = connection
+            return session
+
+    def disconnected(self, connection):
+        # The connection was lost.  The session expires unless the
+        # client reconnects to it in time.
+        with self.lock:
+            self.connections.discard(connection)
+            session = connection.session
+            if (session is None or session.connection is not connection
+                or session.id not in self.sessions):
+                return
+            session.connection = None
+            if not self.stopped:
+                session.expiration = threading.Timer(
+                    session.timeout / 1000.0, self.expire, (session.id, ))
+                session.expiration.daemon = True
+                session.expiration.start()
+
+    def expire(self, session_id):
+        """Expire a session, deleting its ephemeral nodes.
+        """
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+            if session is None:
+                return
+            if session.expiration is not None:
+                session.expiration.cancel()
+            for watches in (self.data_watches, self.child_watches):
+                for path, sessions in list(watches.items()):
+                    sessions.discard(session)
+                    if not sessions:
+                        del watches[path]
+            events = []
+            for path in sorted(session.ephemeral, reverse=True):
+                if path in self.nodes:
+                    self._delete(path, -1, events, [])
+            self._send_events(events)
+            connection = session.connection
+            if connection is not None:
+                connection.close()
+
+    # Tree operations.  Updates add (path, type) watch events to
+    # ``events`` and functions to undo them to ``undo``, so they can
+    # be used in transactions.
+
+    def _node(self, path):
+        _checkpath(path)
+        try:
+            return self.nodes[path]
+        except KeyError:
+            raise Error(kazoo.exceptions.NoNodeError)
+
+    def _check_version(self, node, version, aversion=False):
+        if version != -1 and version != (
+            node.aversion if aversion else node.version):
+            raise Error(kazoo.exceptions.BadVersionError)
+
+    def _create(self, session, path, data, acl, flags, events, undo):
+        _checkpath(path)
+        if path == '/':
+            raise Error(kazoo.exceptions.NodeExistsError)
+        base, name = path.rsplit('/', 1)
+        base = base or '/'
+        parent = self._node(base)
+        if parent.ephemeral_owner:
+            raise Error(kazoo.exceptions.NoChildrenForEphemeralsError)
+        if flags & SEQUENCE:
+            name += '%010d' % parent.cversion
+            path = (base if base != '/' else '') + '/' + name
+        if path in self.nodes:
+            raise Error(kazoo.exceptions.NodeExistsError)
+
+        self.zxid += 1
+        node = Node(data, acl, self.zxid,
+                    session.id if flags & EPHEMERAL else 0)
+        saved = parent.cversion, parent.pzxid
+        self.nodes[path] = node
+        parent.children.add(name)
+        parent.cversion += 1
+        parent.pzxid = self.zxid
+        if node.ephemeral_owner:
+            session.ephemeral.add(path)
+
+        def undo_create():
+            del self.nodes[path]
+            parent.children.discard(name)
+            parent.cversion, parent.pzxid = saved
+            session.ephemeral.discard(path)
+        undo.append(undo_create)
+        events.append((path, CREATED_EVENT))
+        events.append((base, CHILD_EVENT))
+        return path, node
+
+    def _delete(self, path, version, events, undo):
+        if path == '/':
+            raise Error(kazoo.exceptions.BadArgumentsError)
+        node = self._node(path)
+        self._check_version(node, version)
+        if node.children:
+            raise Error(kazoo.exceptions.NotEmptyError)
+        base, name = path.rsplit('/', 1)
+        base = base or '/'
+        parent = self.nodes[base]
+
+        self.zxid += 1
+        saved = parent.cversion, parent.pzxid
+        del self.nodes[path]
+        parent.children.discard(name)
+        parent.cversion += 1
+        parent.pzxid = self.zxid
+        session = self.sessions.get(node.ephemeral_owner)
+        if session is not None:
+            session.ephemeral.discard(path)
+
+        def undo_delete():
+            self.nodes[path] = node
+            parent.children.add(name)
+            parent.cversion, parent.pzxid = saved
+            if session is not None:
+                session.ephemeral.add(path)
+        undo.append(undo_delete)
+        events.append((path, DELETED_EVENT))
+        events.append((base, CHILD_EVENT))
+
+    def _set(self, path, data, version, events, undo):
+        node = self._node(path)
+        self._check_version(node, version)
+        self.zxid += 1
+        saved = node.data, node.version, node.mzxid, node.mtime
+        node.data = data
+        node.version += 1
+        node.mzxid = self.zxid
+        node.mtime = int(time.time() * 1000)
+
+        def undo_set():
+            node.data, node.version, node.mzxid, node.mtime = saved
+        undo.append(undo_set)
+        events.append((path, CHANGED_EVENT))
+        return node
+
+    def _check(self, path, version):
+        self._check_version(self._node(path), version)
+
+    def _send_events(self, events):
+        for path, event in events:
+            if event == CHILD_EVENT:
+                sessions = self.child_watches.pop(path, ())
+            else:
+                sessions = self.data_watches.pop(path, set())
+                if event == DELETED_EVENT:
+                    sessions = sessions | self.child_watches.pop(path, set())
+            if sessions:
+                message = (
+                    reply_header_struct.pack(WATCH_XID, -1, 0) +
+                    watch_event_struct.pack(event, CONNECTED_STATE) +
+                    write_string(path))
+                for session in sessions:
+                    if session.connection is not None:
+                        session.connection.send(message)
+
+    def _watch(self, watches, path, session, watch):
+        if watch:
+            watches[path].add(session)
+
+    def handle(self, session, type, buf, offset):
+        # Handle a request, returning the response body.
+        if type == 1 or type == 15: # create, create2
+            path, data, acl, flags, offset = _read_create(buf, offset)
+            events = []
+            path, node = self._create(
+                session, path, data, acl, flags, events, [])
+            self._send_events(events)
+            result = write_string(path)
+            if type == 15:
+                result += node.stat()
+            return result
+        elif type == 2: # delete
+            path, offset = read_string(buf, offset)
+            version = int_struct.unpack_from(buf, offset)[0]
+            events = []
+            self._delete(path, version, events, [])
+            self._send_events(events)
+            return ''
+        elif type == 3: # exists
+            path, watch = _read_path_watch(buf, offset)
+            _checkpath(path)
+            node = self.nodes.get(path)
+            self._watch(self.data_watches, path, session, watch)
+            if node is None:
+                raise Error(kazoo.exceptions.NoNodeError)
+            return node.stat()
+        elif type == 4: # getData
+            path, watch = _read_path_watch(buf, offset)
+            node = self._node(path)
+            self._watch(self.data_watches, path, session, watch)
+            return write_buffer(node.data) + node.stat()
+        elif type == 5: # setData
+            path, offset = read_string(buf, offset)
+            data, offset = read_buffer(buf, offset)
+            version = int_struct.unpack_from(buf, offset)[0]
+            events = []
+            node = self._set(path, data, version, events, [])
+            self._send_events(events)
+            return node.stat()
+        elif type == 6: # getACL
+            path, offset = read_string(buf, offset)
+            node = self._node(path)
+            return _write_acls(node.acl) + node.stat()
+        elif type == 7: # setACL
+            path, offset = read_string(buf, offset)
+            acl, offset = _read_acls(buf, offset)
+            version = int_struct.unpack_from(buf, offset)[0]
+            node = self._node(path)
+            self._check_version(node, version, True)
+            node.acl = acl
+            node.aversion += 1
+            return node.stat()
+        elif type == 8 or type == 12: # getChildren, getChildren2
+            path, watch = _read_path_watch(buf, offset)
+            node = self._node(path)
+            self._watch(self.child_watches, path, session, watch)
+            result = (int_struct.pack(len(node.children)) +
+                      ''.join(write_string(name)
+                              for name in sorted(node.children)))
+            if type == 12:
+                result += node.stat()
+            return result
+        elif type == 9: # sync
+            path, offset = read_string(buf, offset)
+            return write_string(path)
+        elif type == 14: # multi
+            return self._multi(session, buf, offset)
+        else:
+            raise Error(kazoo.exceptions.UnimplementedError)
+
+    def _multi(self, session, buf, offset):
+        ops = []
+        while 1:
+            type, done, err = multiheader_struct.unpack_from(buf, offset)
+            offset += multiheader_struct.size
+            if done:
+                break
+            if type == 1 or type == 15:
+                path, data, acl, flags, offset = _read_create(buf, offset)
+                ops.append((type, (path, data, acl, flags)))
+            elif type == 2 or type == 13:
+                path, offset = read_string(buf, offset)
+                version = int_struct.unpack_from(buf, offset)[0]
+                offset += int_struct.size
+                ops.append((type, (path, version)))
+            elif type == 5:
+                path, offset = read_string(buf, offset)
+                data, offset = read_buffer(buf, offset)
+                version = int_struct.unpack_from(buf, offset)[0]
+                offset += int_struct.size
+                ops.append((type, (path, data, version)))
+            else:
+                raise Error(kazoo.exceptions.UnimplementedError)
+
+        events = []
+        undo = []
+        results = []
+        for type, args in ops:
+            try:
+                if type == 1 or type == 15:
+                    path, node = self._create(session, *args + (events, undo))
+                    result = write_string(path)
+                    if type == 15:
+                        result += node.stat()
+                elif type == 2:
+                    self._delete(*args + (events, undo))
+                    result = ''
+                elif type == 5:
+                    result = self._set(*args + (events, undo)).stat()
+                else:
+                    self._check(*args)
+                    result = ''
+            except Error, e:
+                break
+            results.append(multiheader_struct.pack(type, False, 0) + result)
+        else:
+            self._send_events(events)
+            return ''.join(results) + multiheader_struct.pack(-1, True, -1)
+
+        # Roll back.  Operations before the failure report success,
+        # and those after it report a runtime inconsistency, as
+        # ZooKeeper does.
+        for f in reversed(undo):
+            f()
+        codes = [0] * len(results) + [e.code]
+        codes += [kazoo.exceptions.RuntimeInconsistency.code] * (
+            len(ops) - len(codes))
+        return ''.join(
+            multiheader_struct.pack(-1, False, code) + int_struct.pack(code)
+            for code in codes) + multiheader_struct.pack(-1, True, -1)
+
+class Connection:
+
+    session = None
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.socket = sock
+        self.closed = False
+        self.output = collections.deque()
+        self.output_ready = threading.Condition()
+        self.last_due = 0
+        self.reader = zc.thread.Thread(self._read)
+        self.writer = zc.thread.Thread(self._write)
+
+    def send(self, message, delay=None):
+        if delay is None:
+            delay = self.server.delay()
+        with self.output_ready:
+            # Keep messages in order, even if delays vary.
+            due = self.last_due = max(time.time() + delay, self.last_due)
+            self.output.append((due, int_struct.pack(len(message)) + message))
+            self.output_ready.notify()
+
+    def _write(self):
+        while 1:
+            with self.output_ready:
+                while not self.output and not self.closed:
+                    self.output_ready.wait(1)
+                if not self.output:
+                    return
+                due, message = self.output.popleft()
+            now = time.time()
+            if due > now:
+                time.sleep(due - now)
+            try:
+                self.socket.sendall(message)
+            except socket.error:
+                return
+
+    def _recv(self, size):
+        data = ''
+        while len(data) < size:
+            chunk = self.socket.recv(size - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def _read(self):
+        server = self.server
+        try:
+            while not self.closed:
+                size = int_struct.unpack(self._recv(4))[0]
+                buf = self._recv(size)
+                if self.session is None:
+                    self._connect(buf)
+                else:
+                    self._request(buf)
+        except (EOFError, socket.error):
+            pass
+        except Exception:
+            logger.exception("Error handling request")
+        self.close(False)
+        server.disconnected(self)
+
+    def _connect(self, buf):
+        server = self.server
+        version, zxid, timeout, session_id = (
+            connect_request_struct.unpack_from(buf, 0))
+        passwd, _ = read_buffer(buf, connect_request_struct.size)
+        session = server.connect(self, session_id, passwd, timeout)
+        if session is None:
+            # Unknown or expired session.
+            self.send(connect_response_struct.pack(0, 0, 0) +
+                      write_buffer('\0' * 16) + '\0', 0)
+            self.close()
+            return
+        self.session = session
+        self.send(connect_response_struct.pack(0, session.timeout, session.id)
+                  + write_buffer(session.passwd) + '\0')
+
+    def _request(self, buf):
+        server = self.server
+        xid, type = request_header_struct.unpack_from(buf, 0)
+        offset = request_header_struct.size
+        if xid == PING_XID or type == 100: # ping, auth
+            self.send(reply_header_struct.pack(xid, server.zxid, 0))
+            return
+        if type == -11: # close
+            self.send(reply_header_struct.pack(xid, server.zxid, 0))
+            server.expire(self.session.id)
+            return
+
+        with server.lock:
+            try:
+                body = server.handle(self.session, type, buf, offset)
+                err = 0
+            except Error, e:
+                body = ''
+                err = e.code
+            self.send(reply_header_struct.pack(xid, server.zxid, err) + body)
+
+    def close(self, flush=True):
+        # Stop, sending any queued output first if flush is true.
+        with self.output_ready:
+            if self.closed:
+                return
+            self.closed = True
+            if not flush:
+                self.output.clear()
+            self.output_ready.notify()
+        if flush and threading.current_thread() is not self.writer:
+            self.writer.join(9)
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
+
+def _checkpath(path):
+    if (not path or path[0] != '/' or badpath(path) or
+        (path != '/' and path.endswith('/'))):
+        raise Error(kazoo.exceptions.BadArgumentsError)
+
+def _read_path_watch(buf, offset):
+    path, offset = read_string(buf, offset)
+    return path, buf[offset] != '\0'
+
+def _read_acls(buf, offset):
+    count = int_struct.unpack_from(buf, offset)[0]
+    offset += int_struct.size
+    acls = []
+    for i in range(max(count, 0)):
+        acl, offset = read_acl(buf, offset)
+        acls.append(acl)
+    return acls, offset
+
+def _write_acls(acls):
+    return int_struct.pack(len(acls)) + ''.join(
+        int_struct.pack(acl.perms) + write_string(acl.id.scheme) +
+        write_string(acl.id.id)
+        for acl in acls)
+
+def _read_create(buf, offset):
+    path, offset = read_string(buf, offset)
+    data, offset = read_buffer(buf, offset)
+    acl, offset = _read_acls(buf, offset)
+    flags = int_struct.unpack_from(buf, offset)[0]
+    return path, data, acl, flags, offset + int_struct.size
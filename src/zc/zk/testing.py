@@ -22,11 +22,17 @@ doctests or with regular ```unittest`` tests.
 from zope.testing import setupstack
 from kazoo.protocol.states import KazooState
 import collections
+import heapq
+import itertools
 import json
 import kazoo.client
+import kazoo.exceptions
+import kazoo.handlers.threading
 import kazoo.protocol.states
+import logging
 import mock
 import os
+import posixpath
 import random
 import re
 import sys
@@ -36,7 +42,8 @@ import traceback
 import zc.zk
 import zc.thread
 
-__all__ = ['assert_', 'setUp', 'tearDown', 'testing_with_real_zookeeper']
+__all__ = ['assert_', 'setUp', 'start_server', 'tearDown',
+           'testing_with_real_zookeeper']
 
 def side_effect(mock):
     return lambda func: setattr(mock, 'side_effect', func)
@@ -88,6 +95,31 @@ def setup_tree(tree, connection_string, root, zookeeper_node=False):
 
     zk.close()
 
+def start_server(tree=None, latency=0):
+    """Start a local ZooKeeper server, for benchmarks and load tests.
+
+    Unlike the emulation used by setUp, this is a real (if simple)
+    server that kazoo clients talk to over a socket.
+
+    tree
+       An initial ZooKeeper tree expressed as an import string.
+       If not passed, the tree used by setUp is created.  Pass an
+       empty string to start with an empty tree.
+
+    latency
+       Seconds to delay responses and watch events by, or a function
+       that returns the delay to use for each message.
+
+    The ``zc.zk.server.Server`` is returned.  Its ``connection_string``
+    attribute has the address to connect to.  Call its ``stop`` method
+    when you're done with it.
+    """
+    import zc.zk.server
+    server = zc.zk.server.Server(latency=latency)
+    if tree is None or tree.strip():
+        setup_tree(tree, server.connection_string, '/')
+    return server
+
 def testing_with_real_zookeeper():
     """Test whether we're testing with a real ZooKeeper server.
 
@@ -117,7 +149,8 @@ class SlowClient(kazoo.client.KazooClient):
         finally:
             time.sleep(self.__test_sleep)
 
-def setUp(test, tree=None, connection_string='zookeeper.example.com:2181'):
+def setUp(test, tree=None, connection_string='zookeeper.example.com:2181',
+          concurrent=False, faults=None):
     """Set up zookeeper emulation.
 
     Standard (mock) testing
@@ -136,6 +169,15 @@ def setUp(test, tree=None, connection_string='zookeeper.example.com:2181'):
        The connection string to use for the emulation server. This
        defaults to 'zookeeper.example.com:2181'.
 
+    concurrent
+       If true, the emulation server doesn't make reads wait for
+       other operations, so it can be used to measure multi-threaded
+       throughput.  Updates are still made one at a time.
+
+    faults
+       A ``Faults`` object describing latency and failures to inject
+       into the emulation.
+
     Testing with a real ZooKeeper Server
     ------------------------------------
 
@@ -173,7 +215,8 @@ def setUp(test, tree=None, connection_string='zookeeper.example.com:2181'):
                 return SlowClient(real_zk+test_root, *a, **k)
 
     else:
-        faux_zookeeper = ZooKeeper(connection_string, Node())
+        faux_zookeeper = ZooKeeper(connection_string, Node(), concurrent)
+        faux_zookeeper.faults = faults
         test_root = '/'
         real_zk = connection_string
 
@@ -205,6 +248,9 @@ def tearDown(test):
 
 class Watch:
 
+    server = None
+    due = 0
+
     def __init__(self, data):
         self.data = data
 
@@ -217,10 +263,446 @@ class Watch:
 
     def update(self, value):
         self.value = value
-        self.func(value)
+        faults = getattr(self.server, 'faults', None)
+        if faults is not None and faults.watch_jitter:
+            faults.notify(self, value)
+        else:
+            self.func(value)
+
+class Faults:
+    """Latency and failures to inject into the emulated server
+
+    Pass an instance to ``setUp``, or assign one to the emulated
+    server's ``faults`` attribute.
+
+    seed
+       A seed for the random-number generator used to make decisions,
+       so runs can be reproduced.
+
+    latency
+       The number of seconds operations take.  This can be a number,
+       a function that's called with a ``random.Random`` instance and
+       returns a number, or a dictionary mapping operation names
+       (``'create'``, ``'get'``, ``'transaction'``, etc.) to numbers or
+       functions, with a ``None`` key for operations not named.
+
+       Operations are performed right away, but their results aren't
+       available until they're due, so asynchronous requests made
+       together overlap, as they would with a real server.  Results
+       for each client become available in the order requested.
+
+    bandwidth
+       The number of bytes per second each client can send and
+       receive.  Node data and names sent and received use up
+       bandwidth, delaying later results.
+
+    watch_jitter
+       The maximum number of seconds by which watch notifications
+       are delayed, chosen at random for each notification.
+       Notifications for a watch are delivered in order.
+
+    disconnect_rate
+       The probability that a client is disconnected, and then
+       reconnected, before an operation.  The operation fails with a
+       ``ConnectionLoss`` error.
+
+    expire_rate
+       The probability that a client's session expires, and a new
+       session is established, before an operation.  The operation
+       fails with a ``ConnectionLoss`` error.
+    """
+
+    def __init__(self, seed=None, latency=0, bandwidth=None, watch_jitter=0,
+                 disconnect_rate=0, expire_rate=0):
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.watch_jitter = watch_jitter
+        self.disconnect_rate = disconnect_rate
+        self.expire_rate = expire_rate
+        self.lock = threading.RLock()
+        self.notified = threading.Condition(self.lock)
+        self.notifications = []
+        self.notifier = None
+        self.sequence = itertools.count()
+
+    def _latency(self, name):
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(name, latency.get(None, 0))
+        if callable(latency):
+            latency = latency(self.random)
+        return latency
+
+    def call(self, client, name, func, args):
+        """Call an operation for a client, returning an AsyncResult.
+        """
+        with self.lock:
+            roll = self.random.random()
+            latency = self._latency(name)
+
+        session = client.zookeeper.sessions.get(client.handle)
+        if session is not None and session.state == KazooState.CONNECTED:
+            if roll < self.expire_rate:
+                client.lose_session()
+                session = None
+            elif roll < self.expire_rate + self.disconnect_rate:
+                session.disconnect()
+                session.connect()
+                session = None
+        if session is None:
+            result = AsyncResult(_raise, kazoo.exceptions.ConnectionLoss)
+        else:
+            result = AsyncResult(func, *args)
+
+        with self.lock:
+            now = time.time()
+            done = now + latency
+            if self.bandwidth:
+                size = _size(args) + _size(result.value)
+                client.link_free = max(now, client.link_free) + (
+                    size / float(self.bandwidth))
+                done = client.link_free + latency
+            result.due = client.last_due = max(done, client.last_due)
+        return result
+
+    def notify(self, watch, value):
+        """Deliver a watch notification after a random delay.
+        """
+        with self.lock:
+            due = max(time.time() + self.random.uniform(0, self.watch_jitter),
+                      watch.due)
+            watch.due = due
+            heapq.heappush(self.notifications,
+                           (due, next(self.sequence), watch, value))
+            if self.notifier is None:
+                self.notifier = zc.thread.Thread(self._deliver)
+            self.notified.notify()
+
+    def _deliver(self):
+        while 1:
+            with self.lock:
+                if not self.notifications:
+                    self.notifier = None
+                    return
+                due, _, watch, value = self.notifications[0]
+                delay = due - time.time()
+                if delay > 0:
+                    self.notified.wait(delay)
+                    continue
+                heapq.heappop(self.notifications)
+            try:
+                watch.func(value)
+            except Exception:
+                logging.getLogger(__name__).exception(
+                    "Error delivering watch notification")
+
+def _raise(exception_class):
+    raise exception_class()
+
+def _size(value):
+    # The approximate number of bytes in arguments or results.
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(_size(v) for v in value)
+    return 0
+
+class TreeGenerator:
+    """Generate synthetic trees, for scale tests and benchmarks
+
+    Trees are generated from a seed, so the same options always
+    produce the same tree.  Use ``text`` to get import text, suitable
+    for ``parse_tree`` and ``import_tree``, or ``populate`` to add the
+    tree to an emulated server without going through a client.
+
+    seed
+       A seed for the random-number generator used to make the tree.
+
+    fanout
+       The number of children of each node not at the maximum depth.
+
+    depth
+       The depth of the tree below the node it's imported into.
+
+    properties
+       The number of properties of each node.
+
+    property_size
+       The number of characters in string property values.  Every
+       third property has an integer value.
+
+    link_density
+       The probability that a node has a symbolic (``->``) link,
+       named ``link``, to some other node in the tree.
+
+    property_links
+       The number of chains of property (``=>``) links.  Each chain
+       has ``chain_length`` links between randomly-chosen nodes,
+       ending at a node with a property value, named ``chainN``, where
+       ``N`` is the chain number.
+
+    Numeric options other than ``seed`` and ``link_density`` may also
+    be given as ``(minimum, maximum)`` tuples, in which case values
+    are chosen at random, independently for each node or chain.
+
+    Links are relative, so trees can be imported anywhere.
+    """
+
+    def __init__(self, seed=0, fanout=3, depth=3, properties=2,
+                 property_size=8, link_density=0, property_links=0,
+                 chain_length=3):
+        self.seed = seed
+        self.fanout = fanout
+        self.depth = depth
+        self.properties = properties
+        self.property_size = property_size
+        self.link_density = link_density
+        self.property_links = property_links
+        self.chain_length = chain_length
+
+    def tree(self):
+        """Return the generated tree, as ``zc.zk.ParseNode`` objects
+        """
+        rand = random.Random(self.seed)
+        number = lambda value: (
+            rand.randint(*value) if isinstance(value, tuple) else value)
+        letters = 'abcdefghijklmnopqrstuvwxyz'
+        nodes = [] # [(path, node)], excluding the root
+
+        def add(node, path, depth):
+            if depth >= number(self.depth):
+                return
+            for i in range(number(self.fanout)):
+                name = 'n%s' % i
+                child = node.children[name] = zc.zk.ParseNode(name)
+                cpath = path + '/' + name
+                nodes.append((cpath, child))
+                for j in range(number(self.properties)):
+                    if j % 3 == 2:
+                        value = rand.randint(0, 1 << 16)
+                    else:
+                        value = ''.join(
+                            rand.choice(letters)
+                            for k in range(number(self.property_size)))
+                    child.properties['p%s' % j] = value
+                add(child, cpath, depth + 1)
+
+        root = zc.zk.ParseNode()
+        add(root, '', 0)
+
+        if self.link_density:
+            for path, node in nodes:
+                if len(nodes) > 1 and rand.random() < self.link_density:
+                    target = path
+                    while target == path:
+                        target = rand.choice(nodes)[0]
+                    node.properties['link ->'] = posixpath.relpath(
+                        target, path)
+
+        for chain in range(self.property_links):
+            length = number(self.chain_length)
+            if length >= len(nodes):
+                raise ValueError("Not enough nodes for property-link chain",
+                                 length)
+            name = 'chain%s' % chain
+            links = rand.sample(nodes, length + 1)
+            for (path, node), (target, _) in zip(links, links[1:]):
+                node.properties[name + ' =>'] = posixpath.relpath(target, path)
+            links[-1][1].properties[name] = chain
+
+        return root
+
+    def text(self):
+        """Return the generated tree as import text
+        """
+        output = []
+        def output_node(node, indent):
+            output.append(indent + '/' + node.name)
+            indent += '  '
+            links = []
+            for name, value in sorted(node.properties.items()):
+                if name.endswith(' ->') or name.endswith(' =>'):
+                    links.append("%s %s" % (name, value))
+                else:
+                    output.append(indent + "%s = %r" % (name, value))
+            output.extend(indent + link for link in links)
+            for name in sorted(node.children):
+                output_node(node.children[name], indent)
+
+        root = self.tree()
+        for name in sorted(root.children):
+            output_node(root.children[name], '')
+        return '\n'.join(output) + '\n'
+
+    def populate(self, zookeeper, path='/'):
+        """Add the generated tree to an emulated server
+
+        ``zookeeper`` is an emulated server, like the ``ZooKeeper``
+        global set up by ``setUp``.  The tree is added below ``path``,
+        which must exist and must not have children with the names of
+        the top-level generated nodes.  Nodes are added directly,
+        which is much faster than importing them.  Child watches on
+        ``path`` are notified.
+        """
+        if isinstance(path, str):
+            path = path.decode('utf8')
+        path = _normpath(path)
+        root = self.tree()
+
+        def add(node, parsed, path):
+            for name, child in sorted(parsed.children.items()):
+                name = name.decode('ascii')
+                cpath = _join(path, name)
+                newnode = Node(zc.zk.encode(child.properties))
+                zookeeper._add_child(node, name, newnode, cpath)
+                add(newnode, child, cpath)
+
+        with zookeeper.lock:
+            node = zookeeper._traverse(path)
+            for name in root.children:
+                if name in node.children:
+                    raise kazoo.exceptions.NodeExistsError(_join(path, name))
+            add(node, root, path)
+            if root.children:
+                node.children_changed(zookeeper.sessions)
+
+class AsyncResult:
+    """Stand-in for kazoo's IAsyncResult
+
+    The emulated server is synchronous, so the result is computed when
+    the request is made.  If latency is being injected, the result
+    isn't available until its due time.
+    """
+
+    due = 0
+    value = None
+
+    def __init__(self, func, *args, **kw):
+        self.exception = None
+        try:
+            self.value = func(*args, **kw)
+        except Exception, v:
+            self.exception = v
+
+    def ready(self):
+        return time.time() >= self.due
+
+    def successful(self):
+        return self.exception is None
+
+    def get(self, block=True, timeout=None):
+        delay = self.due - time.time()
+        if delay > 0:
+            if not block:
+                raise kazoo.handlers.threading.KazooTimeoutError()
+            if timeout is not None and timeout < delay:
+                time.sleep(timeout)
+                raise kazoo.handlers.threading.KazooTimeoutError()
+            time.sleep(delay)
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def rawlink(self, callback):
+        delay = self.due - time.time()
+        if delay > 0:
+            timer = threading.Timer(delay, callback, (self, ))
+            timer.daemon = True
+            timer.start()
+        else:
+            callback(self)
+
+    def unlink(self, callback):
+        pass
+
+class Transaction:
+    """Stand-in for kazoo's TransactionRequest
+
+    Operations are applied in order when the transaction is committed.
+    Like a real server, the emulated server applies all of them or
+    none: if an operation fails, the ones before it are rolled back
+    and the results for the other operations are RolledBackErrors.
+    Watches are only notified if the transaction succeeds.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.operations = []
+
+    def create(self, path, value="", acl=None, ephemeral=False,
+               sequence=False):
+        if acl is None:
+            acl = zc.zk.OPEN_ACL_UNSAFE
+        self.operations.append(
+            ('create', (path, value, acl, ephemeral, sequence)))
+
+    def delete(self, path, version=-1):
+        self.operations.append(('delete', (path, version)))
+
+    def set_data(self, path, value, version=-1):
+        self.operations.append(('set', (path, value, version)))
+
+    def _commit(self, handle):
+        # Faults are injected for the transaction as a whole, not for
+        # its operations.
+        # If an operation fails, the ones before it are undone, and
+        # watches are only notified when all of them succeed, with
+        # one notification per node for child watches.
+        results = []
+        zookeeper = self.client.zookeeper
+        with zookeeper.lock:
+            zookeeper._undo = undo = []
+            zookeeper._deferred = deferred = []
+            try:
+                for name, args in self.operations:
+                    if results and isinstance(results[-1], Exception):
+                        results.append(kazoo.exceptions.RolledBackError())
+                        continue
+                    try:
+                        results.append(
+                            getattr(zookeeper, name)(handle, *args))
+                    except kazoo.exceptions.KazooException, v:
+                        results.append(v)
+            finally:
+                zookeeper._undo = zookeeper._deferred = None
+
+            failed = [i for (i, r) in enumerate(results)
+                      if isinstance(r, Exception)]
+            if failed:
+                for func in reversed(undo):
+                    func()
+                for i in range(failed[0]):
+                    results[i] = kazoo.exceptions.RolledBackError()
+            else:
+                notified = set()
+                for func, args in deferred:
+                    if func.__name__ == 'children_changed':
+                        if func.__self__ in notified:
+                            continue
+                        notified.add(func.__self__)
+                    func(*args)
+        return results
+
+    def commit(self):
+        return self.commit_async().get()
+
+    def commit_async(self):
+        client = self.client
+        faults = client.zookeeper.faults
+        if faults is None:
+            return AsyncResult(self._commit, client.handle)
+        return faults.call(client, 'transaction', self._commit,
+                           (client.handle, ))
 
 class Client:
 
+    # Used by Faults to schedule results:
+    last_due = link_free = 0
+
     def __init__(self, zookeeper, hosts="127.0.0.1:2162", timeout=10.0):
         self.zookeeper = zookeeper
         self.hosts = hosts
@@ -231,7 +713,8 @@ class Client:
     def add_listener(self, func):
         self.listeners.append(func)
 
-    def start(self):
+    def start(self, timeout=15):
+        self.start_timeout = timeout
         def handle(state):
             self.state = state
             for func in self.listeners:
@@ -241,26 +724,45 @@ class Client:
             import kazoo.handlers.threading
             raise kazoo.handlers.threading.TimeoutError('Connection time-out',)
 
+    def _call(self, name, *args):
+        func = getattr(self.zookeeper, name)
+        faults = self.zookeeper.faults
+        if faults is None:
+            return func(self.handle, *args)
+        return faults.call(self, name, func, (self.handle, ) + args).get()
+
+    def _async(self, name, *args):
+        faults = self.zookeeper.faults
+        if faults is None:
+            return AsyncResult(getattr(self, name), *args)
+        return faults.call(
+            self, name, getattr(self.zookeeper, name), (self.handle, ) + args)
+
     def create(self, path, value="", acl=zc.zk.OPEN_ACL_UNSAFE,
                ephemeral=False, sequence=False):
-        return self.zookeeper.create(self.handle, path, value, acl,
-                                     ephemeral, sequence)
+        return self._call('create', path, value, acl, ephemeral, sequence)
 
     def ensure_path(self, path, acl=zc.zk.OPEN_ACL_UNSAFE):
-        return self.zookeeper.ensure_path(self.handle, path, acl)
+        return self._call('ensure_path', path, acl)
 
-    def delete(self, path):
-        return self.zookeeper.delete(self.handle, path)
+    def delete(self, path, version=-1):
+        return self._call('delete', path, version)
 
     def ChildrenWatch(self, path):
         node = self.zookeeper._traverse(path)
         watch = Watch(lambda : list(node.children))
+        watch.server = self.zookeeper
         node.child_watchers += ((self.handle, watch), )
+        self.zookeeper.sessions[self.handle].child_watches.append(
+            (path, node, watch))
         return watch
 
     def DataWatch(self, path):
         watch = Watch(lambda : self.zookeeper.get_data(path))
+        watch.server = self.zookeeper
         self.zookeeper.watchers[path] += ((self.handle, watch), )
+        self.zookeeper.sessions[self.handle].data_watches.append(
+            (path, watch))
         return watch
 
     def stop(self):
@@ -279,22 +781,59 @@ class Client:
         session.connect()
 
     def exists(self, path):
-        return self.zookeeper.exists(self.handle, path)
+        return self._call('exists', path)
 
     def get(self, path):
-        return self.zookeeper.get(self.handle, path)
+        return self._call('get', path)
 
     def get_children(self, path):
-        return self.zookeeper.get_children(self.handle, path)
+        return self._call('get_children', path)
+
+    def exists_async(self, path):
+        return self._async('exists', path)
+
+    def get_async(self, path):
+        return self._async('get', path)
+
+    def get_children_async(self, path):
+        return self._async('get_children', path)
+
+    @property
+    def walk(self):
+        # zc.zk.ZooKeeper.walk uses this, if it's not None, to walk
+        # trees without a request per node.  When faults are
+        # injected, requests are made as they would be with a real
+        # server.
+        if self.zookeeper.faults is None:
+            return lambda *args: self.zookeeper.walk(self.handle, *args)
+
+    def create_async(self, path, value="", acl=zc.zk.OPEN_ACL_UNSAFE,
+                     ephemeral=False, sequence=False):
+        return self._async('create', path, value, acl, ephemeral, sequence)
+
+    def set_async(self, path, value, version=-1):
+        return self._async('set', path, value, version)
+
+    def delete_async(self, path, version=-1):
+        return self._async('delete', path, version)
+
+    def set_acls_async(self, path, acls, aversion=-1):
+        return self._async('set_acls', path, acls, aversion)
+
+    def transaction(self):
+        return Transaction(self)
 
     def get_acls(self, path):
-        return self.zookeeper.get_acls(self.handle, path)
+        return self._call('get_acls', path)
 
     def set_acls(self, path, acls, aversion=-1):
-        return self.zookeeper.set_acls(self.handle, path, acls, aversion)
+        return self._call('set_acls', path, acls, aversion)
+
+    def get_acls_async(self, path):
+        return self._async('get_acls', path)
 
     def set(self, path, value, version=-1):
-        return self.zookeeper.set(self.handle, path, value, version)
+        return self._call('set', path, value, version)
 
 class Session:
 
@@ -305,6 +844,9 @@ class Session:
         self.add = self.nodes.add
         self.remove = self.nodes.remove
         self.watch = watch
+        # The session's watches, so we don't have to search the tree:
+        self.child_watches = [] # [(path, node, watch)]
+        self.data_watches = [] # [(path, watch)]
         self.state = kazoo.protocol.states.KazooState.LOST
         self.session_timeout = session_timeout
 
@@ -338,13 +880,40 @@ class Session:
 
 badpath = re.compile(r'(^|/)\.\.?(/|$)').search
 
+def _normpath(path):
+    # The canonical form of a path, as _traverse has always interpreted it.
+    return '/' + '/'.join(name for name in path.split('/')[1:] if name)
+
+def _join(base, name):
+    return (base if base != '/' else '') + '/' + name
+
+class _NoLock:
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
 class ZooKeeper:
 
-    def __init__(self, connection_string, tree):
+    faults = None
+
+    def __init__(self, connection_string, tree, concurrent=False):
         self.connection_strings = set([connection_string])
         self.root = tree
+        # Index of nodes by canonical path, maintained by create,
+        # ensure_path and delete.
+        self.nodes = {}
+        self._index('/', tree)
         self.sessions = {}
         self.lock = threading.RLock()
+
+        # In concurrent mode, reads don't wait for the lock, which
+        # only serializes updates.  Children dictionaries are replaced
+        # rather than changed, so readers never see them change.
+        self.concurrent = concurrent
+        self.read_lock = _NoLock() if concurrent else self.lock
         self.failed = {}
         self.sequence_number = 0
         self.watchers = collections.defaultdict(tuple)
@@ -377,6 +946,40 @@ class ZooKeeper:
             session.check()
         return session
 
+    # While a transaction is being committed, these are lists of
+    # functions to undo its operations and of notifications to send
+    # if it succeeds.
+    _undo = _deferred = None
+
+    def _notify(self, func, *args):
+        if self._deferred is None:
+            func(*args)
+        else:
+            self._deferred.append((func, args))
+
+    def _add_child(self, node, name, child, path):
+        self.nodes[path] = child
+        if self.concurrent:
+            children = dict(node.children)
+            children[name] = child
+            node.children = children
+        else:
+            node.children[name] = child
+
+    def _remove_child(self, node, name, path):
+        if self.concurrent:
+            children = dict(node.children)
+            del children[name]
+            node.children = children
+        else:
+            del node.children[name]
+        del self.nodes[path]
+
+    def _index(self, path, node):
+        self.nodes[path] = node
+        for name, child in node.children.items():
+            self._index(_join(path, name), child)
+
     def _traverse(self, path):
         """This is used by a bunch of the methods.
 
@@ -406,17 +1009,14 @@ class ZooKeeper:
         """
         if badpath(path):
             raise kazoo.exceptions.BadArgumentsError('bad argument')
-        node = self.root
-        for name in path.split('/')[1:]:
-            if not name:
-                continue
+        try:
+            return self.nodes[path]
+        except KeyError:
             try:
-                node = node.children[name]
+                return self.nodes[_normpath(path)]
             except KeyError:
                 raise kazoo.exceptions.NoNodeError('no node')
 
-        return node
-
     def _clear_session(self, session, close=False):
         """
         Test: don't sweat ephemeral nodes that were already deleted
@@ -432,12 +1032,18 @@ class ZooKeeper:
         """
         handle = session.handle
         with self.lock:
-            self.root.clear_watchers(handle, close)
-            for path in self.watchers:
-                self.watchers[path] = tuple(
-                    (h, w) for (h, w) in self.watchers[path]
-                    if h != handle or not close
-                    )
+            if close:
+                for node in set(node for _, node, _ in session.child_watches):
+                    node.clear_watchers(handle)
+                for path in set(path for path, _ in session.data_watches):
+                    self.watchers[path] = tuple(
+                        (h, w) for (h, w) in self.watchers[path]
+                        if h != handle
+                        )
+                    if not self.watchers[path]:
+                        del self.watchers[path]
+                session.child_watches = []
+                session.data_watches = []
             for path in list(session.nodes):
                 try:
                     self._delete(session.handle, path, clear=True)
@@ -445,14 +1051,50 @@ class ZooKeeper:
                     pass # deleted in another session, perhaps
 
     def _restore_session(self, session):
-        handle = session.handle
+        """
+        Watches are indexed by session, so closing a session only
+        touches its own watches:
+
+        >>> zk = zc.zk.ZK('zookeeper.example.com:2181')
+        >>> zk2 = zc.zk.ZK('zookeeper.example.com:2181')
+        >>> children = zk.children('/fooservice')
+        >>> properties = zk.properties('/fooservice')
+        >>> children2 = zk2.children('/fooservice')
+        >>> session = ZooKeeper.sessions[zk.client.handle]
+        >>> [p for p, n, w in session.child_watches]
+        ['/fooservice']
+        >>> sorted(p for p, w in session.data_watches)
+        ['/fooservice', '/fooservice']
+        >>> node = ZooKeeper._traverse('/fooservice')
+        >>> len(node.child_watchers)
+        2
+
+        >>> zk.close()
+        >>> session.child_watches, session.data_watches
+        ([], [])
+        >>> [h for h, w in node.child_watchers] == [zk2.client.handle]
+        True
+        >>> [h for h, w in ZooKeeper.watchers[u'/fooservice']
+        ...  if h == zk.client.handle]
+        []
+
+        >>> zk2.close()
+        """
         with self.lock:
-            self.root.restore_watchers(handle)
-            for path in self.watchers:
+            # Watches on deleted nodes are dropped.
+            session.child_watches = [
+                (path, node, watch)
+                for path, node, watch in session.child_watches
+                if self.nodes.get(_normpath(path)) is node
+                ]
+            for path, node, watch in session.child_watches:
+                value = list(node.children)
+                if value != watch.value:
+                    watch.update(value)
+            for path, watch in session.data_watches:
                 value = self.get_data(path)
-                for h, w in self.watchers[path]:
-                    if h == handle and value != w.value:
-                        w.update(value)
+                if value != watch.value:
+                    watch.update(value)
 
     def close(self, handle):
         with self.lock:
@@ -460,7 +1102,7 @@ class ZooKeeper:
             self.sessions.pop(handle).disconnect()
 
     def state(self, handle):
-        with self.lock:
+        with self.read_lock:
             return self._check_handle(handle, False).state
 
     def create(self, handle, path, data, acl, ephemeral=False, sequence=False):
@@ -473,23 +1115,56 @@ class ZooKeeper:
         with self.lock:
             self._check_handle(handle)
             node = self._traverse(base or u'/')
+            seqno = node.child_seqno
             if sequence:
-                name = "%s%010d" % (name, node.child_seqno)
+                name = "%s%010d" % (name, seqno)
                 node.child_seqno += 1
                 path = u'%s/%s' % (base, name)
             if name in node.children:
                 raise kazoo.exceptions.NodeExistsError()
-            node.children[name] = newnode = Node(data)
+            newnode = Node(data)
             newnode.acl = acl
             newnode.ephemeral = ephemeral
-            node.children_changed(self.sessions)
+            npath = _join(_normpath(base), name)
+            self._add_child(node, name, newnode, npath)
+            self._notify(node.children_changed, self.sessions)
             for h, w in self.watchers.get(path, ()):
-                w.update(data)
+                self._notify(w.update, data)
             if ephemeral:
                 self.sessions[handle].add(path)
+            if self._undo is not None:
+                def undo():
+                    self._remove_child(node, name, npath)
+                    node.child_seqno = seqno
+                    if ephemeral:
+                        self.sessions[handle].remove(path)
+                self._undo.append(undo)
             return path
 
     def ensure_path(self, handle, path, acl):
+        """Create a node and any missing ancestors.
+
+        Nodes are indexed by path as they're created and deleted:
+
+        >>> zk = zc.zk.ZK('zookeeper.example.com:2181')
+        >>> zk.client.ensure_path('/test_ensure/a/b//c/')
+        u'/test_ensure/a/b//c'
+        >>> zk.client.ensure_path('/test_ensure/a/b')
+        True
+        >>> sorted(p for p in ZooKeeper.nodes if p.startswith('/test_ensure'))
+        ... # doctest: +NORMALIZE_WHITESPACE
+        [u'/test_ensure', u'/test_ensure/a', u'/test_ensure/a/b',
+         u'/test_ensure/a/b/c']
+        >>> zk.get('/test_ensure/a/b/c')[1] is zk.get('//test_ensure/a/b/c/')[1]
+        True
+
+        >>> zk.delete_recursive('/test_ensure')
+        >>> [p for p in ZooKeeper.nodes if p.startswith('/test_ensure')]
+        []
+        >>> zk.exists('/test_ensure/a')
+
+        >>> zk.close()
+        """
         if isinstance(path, str):
             path = path.decode('utf8')
         while path.endswith('/'):
@@ -498,20 +1173,33 @@ class ZooKeeper:
             return True
         if not path.startswith('/'):
             path = '/' + path
-        base, name = path.rsplit('/', 1)
-        self.ensure_path(handle, base, acl)
 
         with self.lock:
             self._check_handle(handle)
-            node = self._traverse(base or '/')
-            if name in node.children:
+            if badpath(path):
+                raise kazoo.exceptions.BadArgumentsError('bad argument')
+
+            # Find the nearest existing ancestor, then create the rest.
+            missing = []
+            npath = _normpath(path)
+            while npath not in self.nodes:
+                npath, name = npath.rsplit('/', 1)
+                missing.append(name)
+                npath = npath or '/'
+            if not missing:
                 return True
-            node.children[name] = newnode = Node('')
-            newnode.acl = acl
-            newnode.ephemeral = False
-            node.children_changed(self.sessions)
-            for h, w in self.watchers.get(path, ()):
-                w.update('')
+
+            node = self.nodes[npath]
+            for name in reversed(missing):
+                npath = _join(npath, name)
+                newnode = Node('')
+                newnode.acl = acl
+                newnode.ephemeral = False
+                self._add_child(node, name, newnode, npath)
+                node.children_changed(self.sessions)
+                for h, w in self.watchers.get(npath, ()):
+                    w.update('')
+                node = newnode
             return path
 
     def _delete(self, handle, path, version=-1, clear=False):
@@ -522,14 +1210,22 @@ class ZooKeeper:
             raise kazoo.exceptions.NotEmptyError('not empty')
         base, name = path.rsplit('/', 1)
         bnode = self._traverse(base or '/')
-        del bnode.children[name]
+        npath = _join(_normpath(base), name)
+        self._remove_child(bnode, name, npath)
         for h, w in self.watchers.get(path, ()):
-            w.update(None)
+            self._notify(w.update, None)
 
-        node.deleted()
-        bnode.children_changed(self.sessions)
-        if path in self.sessions[handle].nodes:
+        self._notify(node.deleted)
+        self._notify(bnode.children_changed, self.sessions)
+        ephemeral = path in self.sessions[handle].nodes
+        if ephemeral:
             self.sessions[handle].remove(path)
+        if self._undo is not None:
+            def undo():
+                self._add_child(bnode, name, node, npath)
+                if ephemeral:
+                    self.sessions[handle].add(path)
+            self._undo.append(undo)
 
     def delete(self, handle, path, version=-1):
         with self.lock:
@@ -552,7 +1248,7 @@ class ZooKeeper:
 
         >>> zk.close()
         """
-        with self.lock:
+        with self.read_lock:
             self._check_handle(handle)
             try:
                 node = self._traverse(path)
@@ -561,19 +1257,52 @@ class ZooKeeper:
                 return None
 
     def get_children(self, handle, path):
-        with self.lock:
+        with self.read_lock:
             self._check_handle(handle)
             node = self._traverse(path)
             return list(node.children)
 
     def get(self, handle, path):
-        with self.lock:
+        with self.read_lock:
             self._check_handle(handle)
             node = self._traverse(path)
             return node.data, node
 
+    def walk(self, handle, path, ephemeral=True, children=False, data=False):
+        # Walk a subtree the way zc.zk.ZooKeeper.walk does, but
+        # looking nodes up in the path index rather than making
+        # requests for each node.  Nothing is fetched ahead, so
+        # changes made while walking are always reflected.
+        if badpath(path):
+            raise kazoo.exceptions.BadArgumentsError('bad argument')
+        top = path
+        stack = [(path, _normpath(path))]
+        while stack:
+            path, key = stack.pop()
+            with self.read_lock:
+                self._check_handle(handle)
+                node = self.nodes.get(key)
+                if node is None:
+                    continue
+                _children = sorted(node.children)
+                node_data = node.data
+
+            if path is top and not ephemeral and node.ephemeral:
+                return
+
+            item = (path, )
+            if children and path is top:
+                item += (_children, )
+            if data:
+                item += (node_data, node)
+            yield item if len(item) > 1 else path
+
+            base = path + '/' if path != '/' else '/'
+            stack.extend((base + name, _join(key, name))
+                         for name in reversed(_children))
+
     def recv_timeout(self, handle):
-        with self.lock:
+        with self.read_lock:
             return self._check_handle(handle, False).session_timeout
 
     def set(self, handle, path, data, version=-1):
@@ -582,9 +1311,12 @@ class ZooKeeper:
             node = self._traverse(path)
             if version != -1 and node.version != version:
                 raise kazoo.exceptions.BadVersionError('bad version')
+            if self._undo is not None:
+                self._undo.append(
+                    lambda old=node.data: setattr(node, 'data', old))
             node.data = data
             for h, w in self.watchers.get(path, ()):
-                w.update(data)
+                self._notify(w.update, data)
             return True
 
     def set_watcher(self, handle, watch):
@@ -592,7 +1324,7 @@ class ZooKeeper:
             self._check_handle(handle).watch = watch
 
     def get_acls(self, handle, path):
-        with self.lock:
+        with self.read_lock:
             self._check_handle(handle)
             node = self._traverse(path)
             return node.acl, node
@@ -639,7 +1371,9 @@ class Node:
         self.ctime = self.mtime = time.time()
 
     def children_changed(self, sessions):
-        value = list(self.children)
+        # Only list the children if they're watched, so adding many
+        # unwatched children isn't quadratic.
+        value = list(self.children) if self.child_watchers else None
         for h, w in self.child_watchers:
             if sessions[h].state == kazoo.protocol.states.KazooState.CONNECTED:
                 w.update(value)
@@ -654,19 +1388,6 @@ class Node:
     def deleted(self):
         self.child_watchers = ()
 
-    def clear_watchers(self, handle, close=False):
+    def clear_watchers(self, handle):
         self.child_watchers = tuple(
-            (h, w) for (h, w) in self.child_watchers
-            if h != handle or not close
-            )
-        for child in self.children.values():
-            child.clear_watchers(handle, close)
-
-    def restore_watchers(self, handle):
-        value = list(self.children)
-        for h, w in self.child_watchers:
-            if h == handle and value != w.value:
-                w.update(value)
-
-        for child in self.children.values():
-            child.restore_watchers(handle)
+            (h, w) for (h, w) in self.child_watchers if h != handle)
@@ -331,6 +331,118 @@ When an expression is messed up, we get sane errors:
     >>> zk.close()
     """
 
+def import_acls():
+    """
+    Imports fetch the data and ACLs of existing nodes in bulk, and
+    only set what's changed:
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> tree = '''
+    ... /test
+    ...   a = 1
+    ...   /c1
+    ...   /c2
+    ... '''
+    >>> zk.import_tree(tree)
+
+    >>> def trace(ob, name, attr):
+    ...     func = getattr(ob, attr)
+    ...     def traced(path, *args):
+    ...         print name, path
+    ...         return func(path, *args)
+    ...     setattr(ob, attr, traced)
+    >>> trace(zk, 'set', '_set')
+    >>> trace(zk.client, 'set_acls', 'set_acls')
+
+    >>> zk.import_tree(tree)
+
+    >>> zk.import_tree(tree, acl=zc.zk.READ_ACL_UNSAFE)
+    set_acls /test
+    set_acls /test/c1
+    set_acls /test/c2
+
+    >>> zk.import_tree(tree, acl=zc.zk.READ_ACL_UNSAFE, dry_run=True)
+    >>> zk.import_tree(tree.replace('a = 1', 'a = 2'), dry_run=True)
+    /test a change from 1 to 2
+    /test acl change
+    /test/c1 acl change
+    /test/c2 acl change
+    >>> zk.diff_tree(tree.replace('a = 1', 'a = 2'), acl=zc.zk.READ_ACL_UNSAFE)
+    [Change('set', '/test')]
+
+    >>> [change] = zk.diff_tree(tree.replace('/c2', ''))[-1:]
+    >>> change, change.describe()
+    (Change('set_acls', '/test/c1'), ['/test/c1 acl change'])
+
+    >>> zk.import_tree(tree.replace('a = 1', 'a = 2'), acl=zc.zk.READ_ACL_UNSAFE)
+    set /test
+    >>> zk.client.get_acls('/test') # doctest: +ELLIPSIS
+    ([ACL(perms=1, ...)], ...)
+
+    >>> zk.close()
+    """
+
+def import_skips_unchanged_data():
+    """
+    Imports don't set data that are unchanged, even if they're
+    formatted differently, and log a summary of what they did:
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> tree = '''
+    ... /test
+    ...   a = 1
+    ...   b = 'x'
+    ...   /c1
+    ...   /c2
+    ...     c = 2
+    ... '''
+    >>> zk.import_tree(tree)
+    >>> _ = zk.set('/test', '{ "b": "x", "a": 1 }')
+
+    >>> @zk.properties('/test')
+    ... def updated(properties):
+    ...     print 'updated', sorted(properties.items())
+    updated [(u'a', 1), (u'b', u'x')]
+
+    >>> handler = zope.testing.loggingsupport.InstalledHandler('zc.zk')
+    >>> zk.import_tree(tree)
+    >>> print handler
+    zc.zk INFO
+      imported /: 0 created, 0 updated, 3 unchanged
+    >>> zk.get('/test')[0]
+    '{ "b": "x", "a": 1 }'
+
+    >>> handler.clear()
+    >>> zk.import_tree(tree.replace('a = 1', 'a = 2') + '  /c3\\n')
+    updated [(u'a', 2), (u'b', u'x')]
+    >>> print handler
+    zc.zk INFO
+      imported /: 1 created, 1 updated, 2 unchanged
+
+    Nothing is logged for dry runs:
+
+    >>> handler.clear()
+    >>> zk.import_tree(tree, dry_run=True)
+    /test a change from 2 to 1
+    extra path not trimmed: /test/c3
+    >>> print handler
+    <BLANKLINE>
+
+    Values of different types are different, even if they're equal
+    in Python:
+
+    >>> _ = zk.delete('/test/c3')
+    >>> zk.import_tree(tree)
+    updated [(u'a', 1), (u'b', u'x')]
+    >>> zk.import_tree(tree.replace('a = 1', 'a = True'))
+    updated [(u'a', True), (u'b', u'x')]
+    >>> zk.import_tree(tree.replace('a = 1', 'a = 1.0'))
+    updated [(u'a', 1.0), (u'b', u'x')]
+
+    >>> handler.uninstall()
+    >>> zk.close()
+    """
+
 def import_dry_run():
     """
 
@@ -503,7 +615,8 @@ def test_server_registeration_event():
     True
     >>> def notify(e):
     ...     print e
-    ...     e.properties['test'] = 1
+    ...     if isinstance(e, zc.zk.RegisteringServer):
+    ...         e.properties['test'] = 1
     >>> zc.zk.event.notify = notify
 
     >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
@@ -517,6 +630,7 @@ def test_server_registeration_event():
         test = 1
 
     >>> zk.close()
+    UnregisteringServer('1.2.3.4:5678', '/fooservice/providers')
 
     >>> sys.modules['zope.event'] = zope.event
     >>> _ = reload(zc.zk.event)
@@ -524,6 +638,39 @@ def test_server_registeration_event():
     True
     """
 
+def unregistering_server_events():
+    """
+    Deleting the ephemeral nodes created by register, or closing the
+    ZooKeeper object, emits UnregisteringServer events once all of a
+    registration's nodes are gone:
+
+    >>> import zc.zk.event
+    >>> notify = zc.zk.event.notify
+    >>> def trace(e):
+    ...     if isinstance(e, zc.zk.UnregisteringServer):
+    ...         print e
+    >>> zc.zk.event.notify = trace
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zk.register('/fooservice/providers', '1.2.3.4:5678')
+    >>> zk.register('/fooservice/providers', '1.2.3.4:5679')
+    >>> _ = zk.delete('/fooservice/providers/1.2.3.4:5678')
+    UnregisteringServer('1.2.3.4:5678', '/fooservice/providers')
+    >>> sorted(zk.ephemeral)
+    ['/fooservice/providers/1.2.3.4:5679']
+
+    Deleting other nodes doesn't emit events:
+
+    >>> _ = zk.create('/fooservice/x')
+    >>> _ = zk.delete('/fooservice/x')
+
+    >>> zk.close()
+    UnregisteringServer('1.2.3.4:5679', '/fooservice/providers')
+    >>> zk.close()
+
+    >>> zc.zk.event.notify = notify
+    """
+
 def register_at_root():
     """
     >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
@@ -1171,6 +1318,1561 @@ def node_data_may_be_None():
     >>> zk.close()
     """
 
+def walk_edge_cases():
+    """
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zk.import_tree('''
+    ... /a
+    ...   /b
+    ...     /c
+    ...   /d
+    ... /e
+    ... ''')
+
+    Walking a missing node yields nothing:
+
+    >>> list(zk.walk('/nothere'))
+    []
+
+    The mock server walks trees itself, unless faults are injected,
+    so inject (no) faults to walk by making requests:
+
+    >>> import zc.zk.testing
+    >>> ZooKeeper.faults = zc.zk.testing.Faults()
+
+    The order doesn't depend on how far ahead we fetch:
+
+    >>> expected = list(zk.walk())
+    >>> expected[:6]
+    ['/', u'/a', u'/a/b', u'/a/b/c', u'/a/d', u'/e']
+    >>> [list(zk.walk(concurrency=n)) == expected for n in (0, 1, 2, 100)]
+    [True, True, True, True]
+
+    Nodes fetched ahead may be yielded even if they've been deleted
+    since:
+
+    >>> for path in zk.walk('/a', concurrency=100):
+    ...     print path
+    ...     if path == '/a/b':
+    ...         zk.delete_recursive('/a/d')
+    /a
+    /a/b
+    /a/b/c
+    /a/d
+
+    But not when nothing is fetched ahead:
+
+    >>> zk.create('/a/d')
+    u'/a/d'
+    >>> for path in zk.walk('/a', concurrency=1):
+    ...     print path
+    ...     if path == '/a/b':
+    ...         zk.delete_recursive('/a/d')
+    /a
+    /a/b
+    /a/b/c
+
+    An ephemeral starting node can be skipped:
+
+    >>> zk.register('/e', 'x')
+    >>> list(zk.walk('/e/x', ephemeral=False))
+    []
+    >>> list(zk.walk('/e/x'))
+    ['/e/x']
+
+    Data can be combined with children:
+
+    >>> i = zk.walk('/a', children=True, data=True)
+    >>> path, children, data, stat = i.next()
+    >>> path, children, data, stat.numChildren
+    ('/a', [u'b'], '{}', 1)
+    >>> del children[:]
+    >>> list(i)
+    []
+
+    >>> ZooKeeper.faults = None
+    >>> zk.close()
+    """
+
+def sequence_children():
+    """
+    Children of nodes with sequence nodes can be kept in sequence
+    order:
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> _ = zk.create('/q')
+    >>> for prefix in 'bbaab':
+    ...     _ = zk.create('/q/' + prefix, sequence=True)
+    >>> _ = zk.create('/q/config')
+    >>> children = zk.children('/q', sequence=True)
+    >>> list(children)
+    ['b0000000000', 'b0000000001', 'a0000000002', 'a0000000003', 'b0000000004']
+    >>> len(children)
+    5
+
+    >>> children.min()
+    'b0000000000'
+    >>> children.next('b0000000001'), children.next(2), children.next(4)
+    ('a0000000002', 'a0000000003', None)
+    >>> children.previous('a0000000002'), children.previous(0)
+    ('b0000000001', None)
+    >>> children.range('a0000000002')
+    ['a0000000002', 'a0000000003', 'b0000000004']
+    >>> children.range(1, 'x0000000003')
+    ['b0000000001', 'a0000000002']
+    >>> children.next('config')
+    Traceback (most recent call last):
+    ...
+    ValueError: ('Not a sequence node name', 'config')
+
+    >>> zc.zk.sequence_number('lock-0000000042'), zc.zk.sequence_number('x')
+    (42, None)
+
+    The children added and removed by the last change are available
+    to callbacks:
+
+    >>> def changed(children):
+    ...     print children.added, children.removed, children.min()
+    >>> _ = children(changed) # doctest: +NORMALIZE_WHITESPACE
+    ['b0000000000', 'b0000000001', 'a0000000002', 'a0000000003',
+     'b0000000004'] [] b0000000000
+    >>> _ = zk.delete('/q/b0000000000')
+    [] ['b0000000000'] b0000000001
+    >>> _ = zk.create('/q/a', sequence=True)
+    ['a0000000005'] [] b0000000001
+
+    >>> children.callbacks.remove(changed)
+
+    The result is the same as sorting, however children change:
+
+    >>> import random
+    >>> rand = random.Random(0)
+    >>> for i in range(50):
+    ...     for name in rand.sample(list(children),
+    ...                             rand.randint(0, len(children))):
+    ...         _ = zk.delete('/q/' + name)
+    ...     for j in range(rand.randint(0, 9)):
+    ...         _ = zk.create('/q/' + rand.choice('ab'), sequence=True)
+    ...     names = [n for n in zk.get_children('/q') if n != 'config']
+    ...     if list(children) != sorted(names, key=zc.zk.sequence_number):
+    ...         print 'oops', i
+    >>> children.range(0, 9)
+    []
+
+    If the node is deleted, there are no children:
+
+    >>> zk.delete_recursive('/q')
+    >>> list(children), children.min(), children.next(0), children.range()
+    ([], None, None, [])
+
+    >>> zk.close()
+    """
+
+def mock_walk():
+    """
+    The mock server walks trees without making a request per node,
+    yielding the same results as walking by making requests:
+
+    >>> import zc.zk.testing
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zc.zk.testing.TreeGenerator(seed=1, link_density=.2).populate(
+    ...     ZooKeeper, '/fooservice')
+    >>> zk.register('/fooservice/providers', 'a:1')
+    >>> options = [dict(path='/'), dict(path='/fooservice/'),
+    ...            dict(path='/fooservice', data=True, children=True),
+    ...            dict(path='/fooservice/providers/a:1', ephemeral=False),
+    ...            dict(path='/nothere')]
+    >>> def walk_all():
+    ...     return ([list(zk.walk(**o)) for o in options],
+    ...             zk.export_tree(), zk.export_tree('/fooservice', True))
+    >>> with mock.patch.object(ZooKeeper, 'get_children') as get_children:
+    ...     native = walk_all()
+    >>> get_children.called
+    False
+    >>> ZooKeeper.faults = zc.zk.testing.Faults()
+    >>> native == walk_all()
+    True
+    >>> ZooKeeper.faults = None
+    >>> len(native[0][0])
+    45
+
+    Changes made while walking are reflected:
+
+    >>> for path in zk.walk('/fooservice'):
+    ...     if path.endswith('/n1'):
+    ...         zk.delete_recursive(path)
+    ...     elif path.count('/') == 4:
+    ...         print path
+    /fooservice/n0/n0/n0
+    /fooservice/n0/n0/n2
+    /fooservice/n0/n2/n0
+    /fooservice/n0/n2/n2
+    /fooservice/n2/n0/n0
+    /fooservice/n2/n0/n2
+    /fooservice/n2/n2/n0
+    /fooservice/n2/n2/n2
+
+    >>> list(zk.walk('..'))
+    Traceback (most recent call last):
+    ...
+    BadArgumentsError: bad argument
+
+    >>> zk.close()
+    """
+
+def snapshots():
+    """
+    >>> import tempfile
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zk.register('/fooservice/providers', 'a:1')
+    >>> _ = zk.create('/fooservice/empty', None)
+    >>> zk.ln('/fooservice', '/fooservice/providers/self')
+
+    >>> tmp = tempfile.mkdtemp()
+    >>> filename = os.path.join(tmp, 'snapshot')
+    >>> zk.save_snapshot(filename, '/fooservice')
+    >>> os.listdir(tmp)
+    ['snapshot']
+
+    >>> snapshot = zc.zk.Snapshot(filename)
+    >>> snapshot.path
+    u'/fooservice'
+    >>> pprint(sorted(snapshot.nodes))
+    [u'/fooservice',
+     u'/fooservice/empty',
+     u'/fooservice/providers',
+     u'/fooservice/providers/a:1']
+    >>> sorted(snapshot.get_children('/fooservice'))
+    [u'empty', u'providers']
+    >>> snapshot.get('/fooservice/empty')
+    (None, SnapshotStat(version=0, ephemeralOwner=False, numChildren=0))
+    >>> bool(snapshot.exists('/fooservice/providers/a:1').ephemeralOwner)
+    True
+    >>> snapshot.exists('/nothere')
+    >>> snapshot.get('/nothere')
+    Traceback (most recent call last):
+    ...
+    NoNodeError: /nothere
+
+    Links are resolved within the snapshot:
+
+    >>> snapshot.resolve('/fooservice/providers/self/empty')
+    u'/fooservice/empty'
+
+    Now, we'll change the tree and start from the (stale) snapshot:
+
+    >>> zk.properties('/fooservice').update(threads=2)
+    >>> _ = zk.create('/other', '{"x": 1}')
+    >>> zk.close()
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181', snapshot=filename)
+
+    The properties start with the data from the snapshot and are
+    updated from ZooKeeper in the background:
+
+    >>> properties = zk.properties('/fooservice')
+    >>> wait(lambda : properties.get('threads') == 2)
+
+    Children that haven't changed don't cause callbacks when
+    reconciled:
+
+    >>> children = zk.children('/fooservice')
+    >>> @children
+    ... def changed(children):
+    ...     print 'children', sorted(children)
+    children ['empty', 'providers']
+    >>> wait(lambda : not zk._unreconciled)
+    >>> wait(lambda : children._snapshot_data is None)
+
+    Once reconciled, we see changes as usual:
+
+    >>> _ = zk.create('/fooservice/new')
+    children ['empty', 'new', 'providers']
+
+    Paths outside the snapshot are handled normally:
+
+    >>> dict(zk.properties('/other'))
+    {u'x': 1}
+    >>> zk.properties('/nothere')
+    Traceback (most recent call last):
+    ...
+    NoNodeError: /nothere
+
+    >>> zk.close()
+    >>> import shutil
+    >>> shutil.rmtree(tmp)
+    """
+
+def snapshots_while_disconnected():
+    """
+    >>> import tempfile
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zk.import_tree('''
+    ... /snap
+    ...   threads = 1
+    ...   db_threads => db threads
+    ...   /db
+    ...     threads = 3
+    ... ''')
+    >>> tmp = tempfile.mkdtemp()
+    >>> filename = os.path.join(tmp, 'snapshot')
+    >>> zk.save_snapshot(filename, '/snap')
+    >>> zk.properties('/snap').update(threads=99)
+
+    If we can't connect, watches start with data from the snapshot,
+    and property links are resolved within the snapshot:
+
+    >>> offline = zc.zk.ZooKeeper('offline.example.com:2181',
+    ...                           snapshot=filename)
+
+    We didn't wait long to give up connecting:
+
+    >>> offline.client.start_timeout
+    1.0
+
+    >>> properties = offline.properties('/snap')
+    >>> properties['threads'], properties['db_threads']
+    (1, 3)
+
+    >>> children = offline.children('/snap')
+    >>> @children
+    ... def changed(children):
+    ...     print 'children', sorted(children)
+    children ['db']
+
+    When we connect, they're reconciled with ZooKeeper.  Children that
+    haven't changed don't cause callbacks:
+
+    >>> ZooKeeper._allow_connection('offline.example.com:2181')
+    >>> wait(lambda : properties['threads'] == 99)
+    >>> wait(lambda : not offline._unreconciled)
+    >>> wait(lambda : children._snapshot_data is None)
+    >>> properties['db_threads']
+    3
+
+    Once reconciled, we see changes as usual:
+
+    >>> _ = zk.create('/snap/new')
+    children ['db', 'new']
+
+    >>> import threading
+    >>> wait(lambda : 'zc.zk.connect' not in
+    ...      [t.name for t in threading.enumerate()])
+    >>> offline.close()
+
+    A ZooKeeper object that's closed before connecting stops trying:
+
+    >>> offline = zc.zk.ZooKeeper('unreachable.example.com:2181',
+    ...                           snapshot=filename)
+    >>> offline.close()
+    >>> wait(lambda : 'zc.zk.connect' not in
+    ...      [t.name for t in threading.enumerate()])
+
+    Data that aren't UTF-8, like pickles, are saved too:
+
+    >>> _ = zk.create('/snap/binary', '\\xff\\xfe')
+    >>> zk.save_snapshot(filename, '/snap')
+    >>> zc.zk.load_snapshot(filename).get('/snap/binary')[0]
+    '\\xff\\xfe'
+    >>> dict(zc.zk.load_snapshot(filename).get_properties('/snap/db'))
+    {u'threads': 3}
+
+    >>> zk.close()
+    >>> import shutil
+    >>> shutil.rmtree(tmp)
+    """
+
+def mapped_snapshots():
+    r"""
+    >>> import tempfile
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zk.import_tree('''
+    ... /a
+    ...   x = 1
+    ...   link -> b
+    ...   /b
+    ...     /c
+    ...   /b-x
+    ... ''')
+    >>> _ = zk.create(u'/a/\xe9t\xe9')
+    >>> zk.register('/a', 'a:1')
+    >>> _ = zk.create('/a/empty', None)
+
+    >>> tmp = tempfile.mkdtemp()
+    >>> filename = os.path.join(tmp, 'snapshot')
+    >>> zk.save_snapshot(filename, mapped=True)
+    >>> os.listdir(tmp)
+    ['snapshot']
+
+    >>> snapshot = zc.zk.load_snapshot(filename)
+    >>> snapshot.__class__.__name__
+    'MappedSnapshot'
+    >>> snapshot.path
+    u'/'
+    >>> len(snapshot) == len(list(zk.walk()))
+    True
+
+    Every node is available, with the same data and children:
+
+    >>> for path, data, stat in zk.walk(data=True):
+    ...     sdata, sstat = snapshot.get(path)
+    ...     if (sdata != data or
+    ...         sorted(snapshot.get_children(path)) !=
+    ...         sorted(zk.get_children(path)) or
+    ...         sstat.numChildren != stat.numChildren or
+    ...         sstat.ephemeralOwner != bool(stat.ephemeralOwner)):
+    ...         print 'wrong', path
+
+    >>> sorted(snapshot.get_children('/a'))
+    [u'a:1', u'b', u'b-x', u'empty', u'\xe9t\xe9']
+    >>> snapshot.get('/a/empty')
+    (None, SnapshotStat(version=0, ephemeralOwner=False, numChildren=0))
+    >>> sorted(snapshot.get_properties('/a').items())
+    [(u'link ->', u'b'), (u'x', 1)]
+    >>> snapshot.resolve('/a/link/c')
+    u'/a/b/c'
+
+    >>> snapshot.exists('/a/d')
+    >>> snapshot.exists('/a/b/c/d')
+    >>> snapshot.get('/nothere')
+    Traceback (most recent call last):
+    ...
+    NoNodeError: /nothere
+    >>> snapshot.get_children('/a/nothere')
+    Traceback (most recent call last):
+    ...
+    NoNodeError: /a/nothere
+
+    Subtrees can be saved too:
+
+    >>> zk.save_snapshot(filename, '/a/b', mapped=True)
+    >>> snapshot.close()
+    >>> snapshot = zc.zk.MappedSnapshot(filename)
+    >>> snapshot.path, len(snapshot)
+    (u'/a/b', 2)
+    >>> snapshot.get_children('/a/b')
+    [u'c']
+    >>> snapshot.exists('/a')
+
+    Mapped snapshots can be used to start ZooKeeper objects:
+
+    >>> zk2 = zc.zk.ZooKeeper('zookeeper.example.com:2181',
+    ...                       snapshot=filename)
+    >>> isinstance(zk2.snapshot, zc.zk.MappedSnapshot)
+    True
+    >>> list(zk2.children('/a/b'))
+    ['c']
+    >>> wait(lambda : not zk2._unreconciled)
+    >>> zk2.close()
+
+    >>> zc.zk.MappedSnapshot(zc.zk.__file__) # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ValueError: ('Not a mapped snapshot', ...)
+
+    >>> snapshot.close()
+    >>> zk.close()
+    >>> import shutil
+    >>> shutil.rmtree(tmp)
+    """
+
+def diff_tree():
+    """
+    diff_tree reports the changes a dry-run import would describe:
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zk.import_tree('''
+    ... /test
+    ...   a=1
+    ...   b = 2
+    ...   /c1
+    ...     /c12
+    ...   /c2
+    ...     /c21
+    ...   ae->         /x
+    ... ''')
+    >>> zk.register('/test/c2', 'a:1')
+
+    >>> tree = '''
+    ... /test
+    ...   a=2
+    ...   /c1
+    ...     /c12
+    ...       a = 1
+    ...       /c123
+    ...   ae->         /x
+    ... '''
+    >>> for change in zk.diff_tree(tree):
+    ...     print change
+    ...     for line in change.describe():
+    ...         print '   ', line
+    Change('set', '/test')
+        /test a change from 1 to 2
+        /test remove property b = 2
+    Change('extra', u'/test/c2')
+        extra path not trimmed: /test/c2
+    Change('set', '/test/c1/c12')
+        /test/c1/c12 add property a = 1
+    Change('create', '/test/c1/c12/c123')
+        add /test/c1/c12/c123
+
+    When trimming, ephemeral nodes and their ancestors are left alone:
+
+    >>> for change in zk.diff_tree(tree, trim=True):
+    ...     print change
+    Change('set', '/test')
+    Change('delete', u'/test/c2/c21')
+    Change('set', '/test/c1/c12')
+    Change('create', '/test/c1/c12/c123')
+
+    The changes match what an import does:
+
+    >>> zk.import_tree(tree, trim=True)
+    Not deleting /test/c2/a:1 because it's ephemeral.
+    /test/c2 not deleted due to ephemeral descendent.
+    >>> zk.diff_tree(tree, trim=True)
+    []
+
+    Values of different types are different, even if they're equal
+    in Python:
+
+    >>> for change in zk.diff_tree(tree.replace('a = 1', 'a = True'),
+    ...                            trim=False):
+    ...     print change, '\\n'.join(change.describe())
+    Change('set', '/test/c1/c12') /test/c1/c12 a change from 1 to True
+    >>> for change in zk.diff_tree(tree.replace('a=2', 'a=2.0'), trim=False):
+    ...     print change, '\\n'.join(change.describe())
+    Change('set', '/test') /test a change from 2 to 2.0
+
+    Sets and deletes carry the versions they were computed against:
+
+    >>> changes = zk.diff_tree('/test\\n  a = 3\\n  /c1\\n    /c12\\n')
+    >>> for change in changes:
+    ...     print change
+    Change('set', '/test')
+    Change('extra', u'/test/c2')
+    Change('set', '/test/c1/c12')
+    Change('extra', u'/test/c1/c12/c123')
+    >>> change = changes[0]
+    >>> change.op, change.version, change.old
+    ('set', 0, '{"a":2,"ae ->":"/x"}')
+
+    Importing at a path that doesn't exist creates it:
+
+    >>> for change in zk.diff_tree('/x\\n  a = 1\\n  /y\\n', '/new/'):
+    ...     print change, change.data, change.acl == zc.zk.OPEN_ACL_UNSAFE
+    Change('create', '/new/x') {"a":1} True
+    Change('create', '/new/x/y') {} True
+
+    >>> zk.close()
+    """
+
+def diff_script_permissions():
+    """
+    The zookeeper_diff script takes the same permission option as
+    zookeeper_import:
+
+    >>> import tempfile, zc.zk.scripts
+    >>> tmp = tempfile.mkdtemp()
+    >>> filename = os.path.join(tmp, 'tree')
+    >>> with open(filename, 'w') as f:
+    ...     f.write('/ro\\n  a = 1\\n  /c\\n')
+    >>> zc.zk.scripts.import_(
+    ...     ['-p', '1', 'zookeeper.example.com:2181', filename])
+
+    >>> zc.zk.scripts.diff(
+    ...     ['-p', '1', 'zookeeper.example.com:2181', filename])
+    >>> zc.zk.scripts.diff(['zookeeper.example.com:2181', filename])
+    /ro acl change
+    /ro/c acl change
+
+    >>> import shutil
+    >>> shutil.rmtree(tmp)
+    """
+
+def apply_changes():
+    """
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zk.import_tree('''
+    ... /test
+    ...   a = 1
+    ...   /c1
+    ...     /c11
+    ...       /c111
+    ...   /c2
+    ... ''')
+
+    Changes can be applied in any order.  Parents are created before
+    their children and deleted after them:
+
+    >>> changes = zk.diff_tree('''
+    ... /test
+    ...   a = 2
+    ...   /c2
+    ...     /c21
+    ...       /c211
+    ...         b = 1
+    ... ''', trim=True)
+    >>> changes.reverse()
+    >>> changes # doctest: +NORMALIZE_WHITESPACE
+    [Change('create', '/test/c2/c21/c211'), Change('create', '/test/c2/c21'),
+     Change('delete', u'/test/c1'), Change('delete', u'/test/c1/c11'),
+     Change('delete', u'/test/c1/c11/c111'), Change('set', '/test')]
+
+    >>> zc.zk._change_waves(changes) # doctest: +NORMALIZE_WHITESPACE
+    [[Change('create', '/test/c2/c21'), Change('set', '/test')],
+     [Change('create', '/test/c2/c21/c211')],
+     [Change('delete', u'/test/c1/c11/c111')],
+     [Change('delete', u'/test/c1/c11')],
+     [Change('delete', u'/test/c1')]]
+
+    >>> applied = zk.apply_changes(changes, concurrency=1)
+    >>> len(applied)
+    6
+    >>> all(change.elapsed >= 0 for change in applied)
+    True
+    >>> zk.print_tree('/test')
+    /test
+      a = 2
+      /c2
+        /c21
+          /c211
+            b = 1
+
+    Sets of properties on created nodes wait for the creates:
+
+    >>> zc.zk._change_waves([
+    ...     zc.zk.Change('set', '/test/x', '{}'),
+    ...     zc.zk.Change('create', '/test/x', ''),
+    ...     zc.zk.Change('extra', '/test/y'),
+    ...     ])
+    [[Change('create', '/test/x')], [Change('set', '/test/x')]]
+
+    >>> zc.zk._change_waves([zc.zk.Change('copy', '/test/x')])
+    Traceback (most recent call last):
+    ...
+    ValueError: ('Unknown change operation', 'copy')
+
+    With batch, creates, sets and deletes are applied in transactions.
+    Single operations and ACL changes are applied without transactions:
+
+    >>> changes = zk.diff_tree('''
+    ... /test
+    ...   /c3
+    ...   /c4
+    ...     /c41
+    ...   /c5
+    ... ''', trim=True)
+    >>> changes.append(zc.zk.Change('set_acls', '/test', acl=zc.zk.READ_ACL_UNSAFE))
+    >>> transaction = zk.client.transaction
+    >>> def traced_transaction():
+    ...     t = transaction()
+    ...     commit = t.commit_async
+    ...     def commit_async():
+    ...         print 'commit', [args[0] for (f, args) in t.operations]
+    ...         return commit()
+    ...     t.commit_async = commit_async
+    ...     return t
+    >>> zk.client.transaction = traced_transaction
+
+    >>> applied = zk.apply_changes(changes, batch=2)
+    commit ['/test', '/test/c3']
+    commit ['/test/c4', '/test/c5']
+    >>> sorted(applied, key=lambda c: c.path) # doctest: +NORMALIZE_WHITESPACE
+    [Change('set_acls', '/test'), Change('set', '/test'),
+     Change('delete', u'/test/c2'), Change('delete', u'/test/c2/c21'),
+     Change('delete', u'/test/c2/c21/c211'), Change('create', '/test/c3'),
+     Change('create', '/test/c4'), Change('create', '/test/c4/c41'),
+     Change('create', '/test/c5')]
+    >>> zk.client.get_acls('/test')[0] == zc.zk.READ_ACL_UNSAFE
+    True
+    >>> zk.print_tree('/test')
+    /test
+      /c3
+      /c4
+        /c41
+      /c5
+
+    >>> zk.client.transaction = transaction
+
+    Errors are raised after outstanding requests have finished.
+    Changes that weren't applied have no elapsed time:
+
+    >>> changes = [zc.zk.Change('create', '/test/c3', ''),
+    ...            zc.zk.Change('create', '/test/c6', ''),
+    ...            zc.zk.Change('create', '/test/c6/c61', '')]
+    >>> zk.apply_changes(changes)
+    Traceback (most recent call last):
+    ...
+    NodeExistsError
+    >>> [change.elapsed is None for change in changes]
+    [True, False, True]
+
+    Transaction failures are raised too:
+
+    >>> changes = [zc.zk.Change('create', '/test/c7', ''),
+    ...            zc.zk.Change('create', '/test/c3', '')]
+    >>> zk.apply_changes(changes, batch=2)
+    Traceback (most recent call last):
+    ...
+    NodeExistsError
+    >>> [change.elapsed is None for change in changes]
+    [True, True]
+
+    >>> zk.close()
+    """
+
+def instrumentation():
+    """
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181',
+    ...                      instrumentation=True)
+    >>> zk.instrumentation.name
+    'zookeeper.example.com:2181'
+
+    >>> _ = zk.create('/test', '')
+    >>> _ = zk.create('/test/a', '')
+    >>> _ = zk.create('/test/a/b', '')
+    >>> zk.get_properties('/test/a/b')
+    {}
+    >>> _ = zk.set('/test/a', '{}')
+    >>> zk.exists('/test/x')
+    >>> zk.get('/test/x')
+    Traceback (most recent call last):
+    ...
+    NoNodeError: no node
+    >>> zk.get_children('/test/a')
+    [u'b']
+    >>> zk.delete('/test/a/b')
+    0
+
+    >>> import pprint
+    >>> stats = zk.instrumentation.stats()
+    >>> sorted(stats)
+    [u'buckets', u'name', u'operations', u'prefixes']
+    >>> stats['buckets']
+    [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0]
+    >>> pprint.pprint(dict((name, (op['count'], op['errors'], sum(op['histogram'])))
+    ...                    for name, op in stats['operations'].items()))
+    {u'create': (3, {}, 3),
+     u'delete': (1, {}, 1),
+     u'exists': (1, {}, 1),
+     u'get': (2, {u'NoNodeError': 1}, 2),
+     u'get_children': (1, {}, 1),
+     u'set': (1, {}, 1)}
+    >>> stats['operations']['get']['time'] >= 0
+    True
+
+    The per-operation statistics can be had without the path-prefix
+    statistics, which can be numerous:
+
+    >>> operation_stats = zk.instrumentation.operation_stats()
+    >>> sorted(operation_stats)
+    ['buckets', 'operations']
+    >>> operation_stats['operations']['get'] == stats['operations']['get']
+    True
+
+    Operations are also counted by path prefix, which defaults to the
+    first 2 path components:
+
+    >>> pprint.pprint(dict((prefix, sorted((name, op['count'])
+    ...                                    for name, op in ops.items()))
+    ...                    for prefix, ops in stats['prefixes'].items()))
+    {u'/test': [(u'create', 1)],
+     u'/test/a': [(u'create', 2),
+                  (u'delete', 1),
+                  (u'get', 1),
+                  (u'get_children', 1),
+                  (u'set', 1)],
+     u'/test/x': [(u'exists', 1), (u'get', 1)]}
+
+    >>> zk.instrumentation.reset()
+    >>> zk.instrumentation.stats()['operations']
+    {}
+
+    The asynchronous requests made by bulk operations, like
+    ``import_tree``, ``apply_changes`` and work-queue ``get``, are
+    recorded too, as are transactions:
+
+    >>> zk.import_tree('/b\\n  /c', '/test')
+    >>> queue = zc.zk.WorkQueue(zk, '/test/queue')
+    >>> _ = queue.put_all(['x', 'y'])
+    >>> queue.get()
+    ['x', 'y']
+    >>> queue.close()
+    >>> pprint.pprint(dict(
+    ...     (name, op['count']) for name, op
+    ...     in zk.instrumentation.stats()['operations'].items()))
+    {u'create': 2, u'exists': 2, u'get': 3, u'get_children': 1, u'transaction': 2}
+
+    Instrumentation objects can be passed to share statistics, and
+    to control the prefix depth and histogram buckets:
+
+    >>> instrumentation = zc.zk.Instrumentation(
+    ...     'test', prefix_depth=1, buckets=[.5])
+    >>> zk2 = zc.zk.ZooKeeper('zookeeper.example.com:2181',
+    ...                       instrumentation=instrumentation)
+    >>> _ = zk2.get('/test/a')
+    >>> instrumentation.record('get', '/test', 1)
+    >>> pprint.pprint(instrumentation.stats()) # doctest: +ELLIPSIS
+    {u'buckets': [0.5],
+     u'name': u'test',
+     u'operations': {u'get': {u'count': 2,
+                              u'errors': {},
+                              u'histogram': [1, 1],
+                              u'time': ...}},
+     u'prefixes': {u'/test': {u'get': {u'count': 2,
+                                       u'errors': {},
+                                       u'histogram': [1, 1],
+                                       u'time': ...}}}}
+
+    Uninstrumented ZooKeeper objects have no instrumentation:
+
+    >>> zk3 = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zk3.instrumentation
+
+    >>> zk.close()
+    >>> zk2.close()
+    >>> zk3.close()
+    """
+
+def watch_stats():
+    """
+    Watches keep statistics about the delivery of notifications:
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> _ = zk.create('/test', '{"a": 1}')
+    >>> properties = zk.properties('/test')
+    >>> children = zk.children('/test')
+    >>> @properties
+    ... def changed(properties):
+    ...     pass
+
+    The initial data from the server count as a notification:
+
+    >>> sorted(properties.metrics.items()) # doctest: +NORMALIZE_WHITESPACE
+    [('callback_time', 0.0), ('calls', 0), ('max_callback_time', 0.0),
+     ('max_delay', 0.0), ('max_lag', None), ('notifications', 1),
+     ('slow_calls', 0)]
+
+    >>> properties.update(a=2)
+    >>> _ = zk.create('/test/c', '')
+    >>> properties.metrics['notifications'], properties.metrics['calls']
+    (2, 1)
+    >>> children.metrics['notifications'], children.metrics['calls']
+    (2, 0)
+
+    ``watch_stats`` returns statistics for the watches in use, slowest
+    callbacks first:
+
+    >>> [(s['type'], s['path'], s['notifications'])
+    ...  for s in zk.watch_stats()]
+    [('Properties', '/test', 2), ('Children', '/test', 2)]
+
+    Callbacks slower than the ZooKeeper object's
+    ``slow_callback_threshold`` are counted and logged:
+
+    >>> handler = zope.testing.loggingsupport.InstalledHandler('zc.zk')
+    >>> zk.slow_callback_threshold = 0
+    >>> @children
+    ... def slow(children):
+    ...     time.sleep(.01)
+    >>> _ = zk.create('/test/d', '')
+    >>> children.metrics['slow_calls']
+    1
+    >>> children.metrics['max_callback_time'] >= .01
+    True
+    >>> print handler # doctest: +ELLIPSIS +NORMALIZE_WHITESPACE
+    zc.zk WARNING
+      Slow callback <function slow at ...> for zc.zk.Children(/test)
+      took 0.0... seconds
+    >>> handler.uninstall()
+
+    When a data event has meta data, the time since the node was
+    modified is tracked too:
+
+    >>> class Stat:
+    ...     mtime = (time.time() - 1) * 1000
+    >>> properties.handle('{"a": 3}', Stat())
+    >>> 1 <= properties.metrics['max_lag'] < 2
+    True
+
+    >>> zk.close()
+    """
+
+def callback_executors():
+    """
+    Callbacks can be run by an executor, rather than by the thread
+    delivering notifications:
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> _ = zk.create('/test', '{"a": 1}')
+    >>> pool = zc.zk.ThreadPool(2)
+
+    >>> properties = zk.properties('/test', executor=pool)
+    >>> children = zk.children('/test', executor=pool)
+
+    The callback is called immediately when it's registered, in the
+    calling thread:
+
+    >>> release = threading.Event()
+    >>> release.set()
+    >>> seen = []
+    >>> @properties
+    ... def slow(properties):
+    ...     release.wait(10)
+    ...     seen.append(('properties', properties['a']))
+    >>> @children
+    ... def fast(children):
+    ...     seen.append(('children', sorted(children)))
+    >>> seen
+    [('properties', 1), ('children', [])]
+    >>> del seen[:]
+
+    A slow callback doesn't hold up notifications, or callbacks of
+    other watches:
+
+    >>> release.clear()
+    >>> properties.update(a=2)
+    >>> properties.update(a=3)
+    >>> _ = zk.create('/test/c', '')
+    >>> from zope.testing.wait import wait
+    >>> wait(lambda : seen == [('children', ['c'])])
+
+    Callbacks for a watch are called one notification at a time, in
+    order:
+
+    >>> release.set()
+    >>> wait(lambda : len(seen) == 3)
+    >>> seen
+    [('children', ['c']), ('properties', 3), ('properties', 3)]
+    >>> properties.metrics['calls']
+    2
+
+    Deletions are reported after earlier notifications, too:
+
+    >>> order = []
+    >>> @properties
+    ... def track(properties=None):
+    ...     if properties is None:
+    ...         order.append('deleted')
+    ...     else:
+    ...         release.wait(10)
+    ...         order.append(properties['a'])
+    >>> release.clear()
+    >>> properties.update(a=4)
+    >>> zk.delete_recursive('/test')
+    >>> release.set()
+    >>> wait(lambda : len(order) == 3)
+    >>> order
+    [3, 4, 'deleted']
+    >>> properties.deleted
+    True
+
+    Any object with a ``submit`` method can be used as an executor.
+
+    >>> pool.shutdown()
+    >>> zk.close()
+    """
+
+def status():
+    """
+    ZooKeeper objects can summarize their state, for monitoring:
+
+    >>> import gc
+    >>> _ = gc.collect() # ZooKeeper objects other tests didn't close
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181',
+    ...                      instrumentation=True)
+    >>> zk.register('/fooservice/providers', 'a:1')
+    >>> properties = zk.properties('/fooservice')
+    >>> children = zk.children('/fooservice/providers')
+    >>> children2 = zk.children('/fooservice/providers')
+
+    >>> import pprint
+    >>> status = zk.status()
+    >>> pprint.pprint(status) # doctest: +ELLIPSIS
+    {'connection': 'zookeeper.example.com:2181',
+     'ephemeral': ['/fooservice/providers/a:1'],
+     'last_restore': None,
+     'operations': {...},
+     'session_history': [(..., 'CONNECTED')],
+     'state': 'CONNECTED',
+     'watches': {'/fooservice': {'Properties': 1},
+                 '/fooservice/providers': {'Children': 2}}}
+    >>> sorted(status['operations'])
+    ['create', 'exists']
+
+    The ``zc.zk.monitor.zookeeper`` plugin outputs the status of open
+    ZooKeeper objects:
+
+    >>> import zc.zk.monitor
+    >>> zc.zk.monitor.zookeeper(sys.stdout, 'zookeeper.example.com:2181')
+    ... # doctest: +ELLIPSIS
+    [{"connection": "zookeeper.example.com:2181", ...}]
+
+    >>> zk.close()
+    >>> zc.zk.monitor.zookeeper(sys.stdout, 'zookeeper.example.com:2181')
+    []
+    """
+
+def mock_faults():
+    """
+    Latency and failures can be injected into the mock server:
+
+    >>> import time, zc.zk.testing
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> ZooKeeper.faults = zc.zk.testing.Faults(
+    ...     seed=1, latency=dict(get=.05, set=lambda r: r.uniform(0, .01)))
+
+    >>> start = time.time()
+    >>> for i in range(4):
+    ...     _ = zk.get('/fooservice')
+    >>> time.time() - start >= .2
+    True
+
+    Asynchronous requests overlap:
+
+    >>> start = time.time()
+    >>> results = [zk.client.get_async('/fooservice') for i in range(10)]
+    >>> results[0].ready()
+    False
+    >>> [r.get()[0] == results[0].get()[0] for r in results] == [True]*10
+    True
+    >>> time.time() - start < .2
+    True
+
+    Operations not named in a latency dictionary take no time:
+
+    >>> zk.exists('/fooservice') is not None
+    True
+
+    Random choices are made with a generator seeded with the given
+    seed, so they can be reproduced:
+
+    >>> def latencies(seed):
+    ...     faults = zc.zk.testing.Faults(
+    ...         seed=seed, latency=lambda r: r.expovariate(100))
+    ...     return [faults._latency('get') for i in range(5)]
+    >>> latencies(42) == latencies(42), latencies(42) == latencies(43)
+    (True, False)
+
+    Bandwidth limits delay operations with a lot of data:
+
+    >>> ZooKeeper.faults = zc.zk.testing.Faults(bandwidth=100000)
+    >>> start = time.time()
+    >>> _ = zk.create('/big', 'x' * 10000)
+    >>> _ = zk.get('/big')
+    >>> time.time() - start >= .2
+    True
+
+    Watch notifications can be delayed by random amounts, but are
+    delivered in order:
+
+    >>> ZooKeeper.faults = zc.zk.testing.Faults(seed=1, watch_jitter=.02)
+    >>> seen = []
+    >>> children = zk.children('/big')
+    >>> @children
+    ... def _(children):
+    ...     seen.append(len(children))
+    >>> for i in range(10):
+    ...     _ = zk.create('/big/%s' % i)
+    >>> len(seen) < 11
+    True
+    >>> wait(lambda : len(seen) == 11)
+    >>> seen
+    [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+
+    Clients can be disconnected, or have their sessions expire at
+    random:
+
+    >>> import kazoo.exceptions
+    >>> ZooKeeper.faults = zc.zk.testing.Faults(disconnect_rate=1)
+    >>> zk.get('/fooservice')
+    Traceback (most recent call last):
+    ...
+    ConnectionLoss
+    >>> zk.state
+    'CONNECTED'
+
+    >>> ZooKeeper.faults = zc.zk.testing.Faults(seed=3, expire_rate=.5)
+    >>> results = []
+    >>> for i in range(20):
+    ...     try:
+    ...         results.append(zk.exists('/fooservice') is not None)
+    ...     except kazoo.exceptions.ConnectionLoss:
+    ...         results.append('lost')
+    >>> 0 < results.count('lost') < 20, results.count(True) + results.count('lost')
+    (True, 20)
+
+    >>> ZooKeeper.faults = None
+    >>> zk.delete_recursive('/big')
+    >>> zk.close()
+    """
+
+def synthetic_trees():
+    """
+    ``zc.zk.testing.TreeGenerator`` generates trees from a seed:
+
+    >>> import zc.zk.testing
+    >>> generator = zc.zk.testing.TreeGenerator(
+    ...     seed=1, fanout=2, depth=2, properties=3, property_size=4,
+    ...     link_density=.5, property_links=1, chain_length=2)
+    >>> text = generator.text()
+    >>> print text,
+    /n0
+      p0 = 'dwtg'
+      p1 = 'mlqu'
+      p2 = 6151
+      /n0
+        chain0 = 0
+        p0 = 'avlt'
+        p1 = 'alsf'
+        p2 = 61950
+      /n1
+        p0 = 'xaao'
+        p1 = 'yjfk'
+        p2 = 1903
+        link -> ../n0
+    /n1
+      p0 = 'flmg'
+      p1 = 'gflh'
+      p2 = 1408
+      chain0 => ../n0/n0
+      /n0
+        p0 = 'voqe'
+        p1 = 'zwdi'
+        p2 = 47283
+        chain0 => ..
+        link -> ../../n0/n0
+      /n1
+        p0 = 'sykv'
+        p1 = 'rhpw'
+        p2 = 55457
+    >>> generator.text() == text
+    True
+
+    Links are relative, so the tree can be imported anywhere:
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zk.import_tree(text, '/fooservice')
+    >>> zk.resolve('/fooservice/n1/n0/link')
+    u'/fooservice/n0/n0'
+    >>> zk.properties('/fooservice/n1/n0', False)['chain0']
+    0
+
+    Or it can be added to an emulated server directly, notifying
+    child watchers:
+
+    >>> _ = zk.create('/generated')
+    >>> children = zk.children('/generated')
+    >>> @children
+    ... def _(children):
+    ...     print sorted(children)
+    []
+    >>> generator.populate(ZooKeeper, '/generated')
+    ['n0', 'n1']
+    >>> paths = [path[len('/generated'):] for path in zk.walk('/generated')]
+    >>> len(paths)
+    7
+    >>> [path for path in paths
+    ...  if zk.get_properties('/generated' + path) !=
+    ...     zk.get_properties('/fooservice' + path)]
+    ['']
+    >>> zk.resolve('/generated/n1/n0/link')
+    u'/generated/n0/n0'
+
+    >>> generator.populate(ZooKeeper, '/generated')
+    Traceback (most recent call last):
+    ...
+    NodeExistsError: /generated/n0
+
+    Options can be ranges:
+
+    >>> text = zc.zk.testing.TreeGenerator(
+    ...     fanout=(1, 5), depth=(2, 3), property_size=(0, 100)).text()
+    >>> text == zc.zk.testing.TreeGenerator(
+    ...     fanout=(1, 5), depth=(2, 3), property_size=(0, 100)).text()
+    True
+    >>> text == zc.zk.testing.TreeGenerator(
+    ...     seed=1, fanout=(1, 5), depth=(2, 3), property_size=(0, 100)
+    ...     ).text()
+    False
+
+    >>> zk.close()
+    """
+
+def mock_concurrent_reads():
+    """
+    The mock server can be created in a concurrent mode, in which
+    reads don't wait for updates:
+
+    >>> server = zc.zk.testing.ZooKeeper(
+    ...     'test:2181', zc.zk.testing.Node(), concurrent=True)
+    >>> client = zc.zk.testing.Client(server, 'test:2181')
+    >>> client.start()
+    >>> client.ensure_path('/test/a')
+    u'/test/a'
+
+    >>> locked = threading.Event()
+    >>> release = threading.Event()
+    >>> @zc.thread.Thread
+    ... def writer():
+    ...     with server.lock:
+    ...         locked.set()
+    ...         release.wait(10)
+
+    >>> locked.wait(10)
+    True
+    >>> client.get_children('/test'), client.exists('/test/a') is not None
+    ([u'a'], True)
+    >>> release.set()
+    >>> writer.join(10)
+
+    Children are replaced on update, so readers iterating over them
+    aren't affected by concurrent changes:
+
+    >>> children = server.nodes['/test'].children
+    >>> _ = client.create('/test/b')
+    >>> sorted(children), sorted(server.nodes['/test'].children)
+    ([u'a'], [u'a', u'b'])
+
+    >>> errors = []
+    >>> def read():
+    ...     try:
+    ...         for i in range(200):
+    ...             for name in client.get_children('/test'):
+    ...                 client.exists('/test/' + name)
+    ...     except Exception, v:
+    ...         errors.append(v)
+    >>> readers = [zc.thread.Thread(read) for i in range(4)]
+    >>> for i in range(200):
+    ...     _ = client.create('/test/c%s' % i)
+    ...     _ = client.delete('/test/c%s' % i)
+    >>> for thread in readers:
+    ...     thread.join(10)
+    >>> errors
+    []
+
+    >>> client.stop()
+    """
+
+def zookeeper_pool():
+    """
+    A ZooKeeperPool spreads operations over several sessions:
+
+    >>> pool = zc.zk.ZooKeeperPool('zookeeper.example.com:2181', size=3)
+    >>> len(pool.sessions), pool.primary is pool.sessions[0]
+    (3, True)
+    >>> len(set(session.client.handle for session in pool.sessions))
+    3
+
+    Each path is assigned to a session, so operations on it are
+    ordered:
+
+    >>> [pool.sessions.index(pool.session(p))
+    ...  for p in ('/fooservice', '/fooservice/providers', '/fooservice/x')]
+    [0, 0, 2]
+
+    >>> pool.create('/fooservice/x', 'x')
+    u'/fooservice/x'
+    >>> pool.get('/fooservice/x')[0]
+    'x'
+    >>> pool.sessions[2].get('/fooservice/x')[0]
+    'x'
+    >>> properties = pool.properties('/fooservice/x', watch=False)
+    >>> properties.zk is pool.sessions[2]
+    True
+
+    Ephemeral nodes are created in the primary session, and later
+    operations on registered nodes use it:
+
+    >>> pool.create('/fooservice/x/e', '', zc.zk.OPEN_ACL_UNSAFE,
+    ...             ephemeral=True)
+    u'/fooservice/x/e'
+    >>> pool.register('/fooservice/x', 'a:1')
+    >>> client = pool.primary.client
+    >>> sorted(client.zookeeper.sessions[client.handle].nodes)
+    [u'/fooservice/x/a:1', u'/fooservice/x/e']
+    >>> sorted(pool.primary.ephemeral)
+    ['/fooservice/x/a:1']
+    >>> pool.session('/fooservice/x/a:1') is pool.primary
+    True
+
+    Other operations use the primary session:
+
+    >>> pool.print_tree('/fooservice/x')
+    /x
+      string_value = 'x'
+      /a:1
+        pid = 9999
+      /e
+
+    >>> len(pool.status())
+    3
+    >>> pool.close()
+    >>> [session.client.state for session in pool.sessions]
+    ['LOST', 'LOST', 'LOST']
+
+    >>> zc.zk.ZooKeeperPool('zookeeper.example.com:2181', size=0)
+    Traceback (most recent call last):
+    ...
+    ValueError: ('size must be at least 1', 0)
+    """
+
+def benchmarks():
+    """
+    The ``zc.zk.bench`` module runs benchmarks of commonly-used
+    operations, returning results that can be saved as JSON:
+
+    >>> import zc.zk.bench
+    >>> results = zc.zk.bench.run(sizes=[20], repeat=1)
+    >>> sorted(results)
+    ['backend', 'latency', 'python', 'repeat', 'results', 'time', 'version']
+    >>> for result in results['results']:
+    ...     print result['benchmark'], result['size'], sorted(
+    ...         name for (name, seconds) in result['seconds'].items()
+    ...         if seconds >= 0)
+    parse_tree 20 ['parse_tree']
+    encode_decode 20 ['decode', 'encode']
+    resolve 20 ['resolve']
+    property_links 20 ['property_links']
+    trees 20 ['delete_recursive', 'export_tree', 'import_tree']
+    watch_fanout 20 ['watch_fanout']
+    ephemeral_restore 20 ['ephemeral_restore', 'ephemeral_restore_duration']
+    work_queue 20 ['work_queue_get', 'work_queue_put']
+
+    Trees are generated with about the requested number of nodes:
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> _ = zk.create('/bench')
+    >>> zk.import_tree(zc.zk.bench.tree_text(25), '/bench')
+    >>> len(list(zk.walk('/bench'))) - 1
+    39
+    >>> zk.close()
+
+    The script writes JSON results:
+
+    >>> import json, os
+    >>> zc.zk.bench.main(['-s', '10', '-r', '1', '-o', 'bench.json',
+    ...                   'encode_decode', 'resolve'])
+    >>> with open('bench.json') as f:
+    ...     results = json.load(f)
+    >>> [(r['benchmark'], r['size']) for r in results['results']]
+    [(u'encode_decode', 10), (u'resolve', 10)]
+    >>> os.remove('bench.json')
+
+    >>> zc.zk.bench.main(['--list'])
+    parse_tree
+    encode_decode
+    resolve
+    property_links
+    trees
+    watch_fanout
+    ephemeral_restore
+    work_queue
+    """
+
+def mock_transactions():
+    """
+    Transactions in the mock server are atomic:
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> _ = zk.create('/t')
+    >>> _ = zk.create('/t/a', 'a')
+    >>> @zk.children('/t')
+    ... def _(children):
+    ...     print sorted(children)
+    ['a']
+
+    >>> t = zk.client.transaction()
+    >>> t.create('/t/s', sequence=True)
+    >>> t.set_data('/t/a', 'x')
+    >>> t.delete('/t/a')
+    >>> t.delete('/t/nothere')
+    >>> t.create('/t/b')
+    >>> t.commit()
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [RolledBackError(), RolledBackError(), RolledBackError(),
+     NoNodeError('no node',), RolledBackError()]
+    >>> zk.get('/t/a')[0]
+    'a'
+
+    Child watches are notified once, when a transaction succeeds:
+
+    >>> t = zk.client.transaction()
+    >>> t.create('/t/s', sequence=True)
+    >>> t.create('/t/s', sequence=True)
+    >>> t.delete('/t/a')
+    >>> t.commit()
+    ['s0000000000', 's0000000001']
+    [u'/t/s0000000000', u'/t/s0000000001', 0]
+
+    >>> zk.close()
+    """
+
+def work_queues():
+    """
+    A WorkQueue keeps items in sequence nodes:
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> queue = zc.zk.WorkQueue(zk, '/queues/work', batch=3)
+    >>> queue.put('a')
+    u'/queues/work/item-0000000000'
+    >>> queue.put_all(['b', 'c', 'd', 'e'])
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [u'/queues/work/item-0000000001', u'/queues/work/item-0000000002',
+     u'/queues/work/item-0000000003', u'/queues/work/item-0000000004']
+    >>> len(queue)
+    5
+
+    Items are claimed, and removed, in batches:
+
+    >>> queue.get()
+    ['a', 'b', 'c']
+    >>> sorted(zk.get_children('/queues/work'))
+    [u'item-0000000003', u'item-0000000004']
+    >>> queue.get()
+    ['d', 'e']
+    >>> queue.get(), len(queue)
+    ([], 0)
+
+    ``get`` can wait for items:
+
+    >>> @zc.thread.Thread
+    ... def put():
+    ...     time.sleep(.1)
+    ...     queue.put('f')
+    >>> queue.get(timeout=9)
+    ['f']
+    >>> put.join()
+    >>> queue.get(timeout=.01)
+    []
+
+    Items claimed by other consumers are skipped, even before the
+    children watch catches up:
+
+    >>> other = zc.zk.WorkQueue(zk, '/queues/work', batch=2)
+    >>> _ = queue.put_all('ghij')
+    >>> with mock.patch.object(queue.children, 'setData'):
+    ...     other.get()
+    ...     queue.get()
+    ['g', 'h']
+    ['i']
+    >>> len(queue.children), len(queue)
+    (4, 1)
+
+    >>> _ = queue.put('k')
+    >>> list(queue.children), queue.get()
+    (['item-0000000009', 'item-0000000010'], ['j', 'k'])
+
+    Even with many consumers, each item is claimed once:
+
+    >>> _ = queue.put_all(str(i) for i in range(1000))
+    >>> consumers = [zc.zk.WorkQueue(zk, '/queues/work', batch=50)
+    ...              for i in range(4)]
+    >>> claimed = []
+    >>> def consume(consumer):
+    ...     while 1:
+    ...         values = consumer.get(timeout=.1)
+    ...         if not values:
+    ...             break
+    ...         claimed.extend(values)
+    >>> threads = [zc.thread.Thread(consume, args=(consumer, ))
+    ...            for consumer in consumers]
+    >>> for thread in threads:
+    ...     thread.join()
+    >>> sorted(claimed, key=int) == [str(i) for i in range(1000)]
+    True
+    >>> [len(q) for q in [queue, other] + consumers]
+    [0, 0, 0, 0, 0, 0]
+
+    >>> for q in [queue, other] + consumers:
+    ...     q.close()
+    >>> queue.children.callbacks
+    []
+    >>> zk.close()
+    """
+
+def prometheus_exposition():
+    r"""
+    >>> import gc
+    >>> _ = gc.collect() # ZooKeeper objects other tests didn't close
+    >>> import zc.zk.monitor
+    >>> zk = zc.zk.ZooKeeper(
+    ...     'zookeeper.example.com:2181',
+    ...     instrumentation=zc.zk.Instrumentation(buckets=[.5, 1]))
+    >>> zk.register('/fooservice/providers', 'a:1')
+    >>> properties = zk.properties('/fooservice')
+    >>> zk.instrumentation.reset()
+    >>> zk.instrumentation.record('get', '/fooservice', .1)
+    >>> zk.instrumentation.record('get', '/fooservice', .7)
+    >>> zk.instrumentation.record('get', '/x', 2, KeyError())
+
+    >>> print zc.zk.monitor.prometheus_text(),
+    # HELP zczk_operations_total ZooKeeper operations performed
+    # TYPE zczk_operations_total counter
+    zczk_operations_total{connection="zookeeper.example.com:2181",operation="get",session="0"} 3
+    # HELP zczk_operation_errors_total ZooKeeper operations that failed, by error
+    # TYPE zczk_operation_errors_total counter
+    zczk_operation_errors_total{connection="zookeeper.example.com:2181",error="KeyError",operation="get",session="0"} 1
+    # HELP zczk_operation_duration_seconds ZooKeeper operation latency
+    # TYPE zczk_operation_duration_seconds histogram
+    zczk_operation_duration_seconds_bucket{connection="zookeeper.example.com:2181",le="0.5",operation="get",session="0"} 1
+    zczk_operation_duration_seconds_bucket{connection="zookeeper.example.com:2181",le="1.0",operation="get",session="0"} 2
+    zczk_operation_duration_seconds_bucket{connection="zookeeper.example.com:2181",le="+Inf",operation="get",session="0"} 3
+    zczk_operation_duration_seconds_sum{connection="zookeeper.example.com:2181",operation="get",session="0"} 2.8
+    zczk_operation_duration_seconds_count{connection="zookeeper.example.com:2181",operation="get",session="0"} 3
+    # HELP zczk_watches Children and Properties objects in use
+    # TYPE zczk_watches gauge
+    zczk_watches{connection="zookeeper.example.com:2181",session="0"} 1
+    # HELP zczk_ephemeral_nodes Ephemeral nodes registered
+    # TYPE zczk_ephemeral_nodes gauge
+    zczk_ephemeral_nodes{connection="zookeeper.example.com:2181",session="0"} 1
+    # HELP zczk_session_state Current ZooKeeper session state
+    # TYPE zczk_session_state gauge
+    zczk_session_state{connection="zookeeper.example.com:2181",session="0",state="CONNECTED"} 1
+    zczk_session_state{connection="zookeeper.example.com:2181",session="0",state="SUSPENDED"} 0
+    zczk_session_state{connection="zookeeper.example.com:2181",session="0",state="LOST"} 0
+
+    Label values are escaped:
+
+    >>> zc.zk.monitor._labels(a='x"y\\z\n')
+    '{a="x\\"y\\\\z\\n"}'
+
+    The ``prometheus`` plugin writes the same text:
+
+    >>> zc.zk.monitor.prometheus(sys.stdout) # doctest: +ELLIPSIS
+    # HELP zczk_operations_total ZooKeeper operations performed
+    ...
+
+    >>> zk.close()
+
+    ZooKeeper objects with the same connection string, like the
+    sessions of a pool, are told apart by the session label:
+
+    >>> pool = zc.zk.ZooKeeperPool('zookeeper.example.com:2181',
+    ...                            instrumentation=True)
+    >>> _ = pool.get('/fooservice')
+    >>> _ = pool.get('/fooservice/providers')
+    >>> lines = zc.zk.monitor.prometheus_text().splitlines()
+    >>> for line in lines:
+    ...     if line.startswith(('zczk_watches', 'zczk_operations_total')):
+    ...         print line
+    zczk_operations_total{connection="zookeeper.example.com:2181",operation="get",session="0"} 1
+    zczk_operations_total{connection="zookeeper.example.com:2181",operation="get",session="1"} 1
+    zczk_watches{connection="zookeeper.example.com:2181",session="0"} 0
+    zczk_watches{connection="zookeeper.example.com:2181",session="1"} 0
+    >>> samples = [line.rsplit(' ', 1)[0] for line in lines
+    ...            if not line.startswith('#')]
+    >>> len(samples) == len(set(samples))
+    True
+    >>> pool.close()
+
+    >>> print zc.zk.monitor.prometheus_text(), # doctest: +ELLIPSIS
+    # HELP zczk_operations_total ZooKeeper operations performed
+    # TYPE zczk_operations_total counter
+    # HELP zczk_operation_errors_total ...
+    """
 
 event = threading.Event()
 def check_async(show=True, expected_status=0):
@@ -1219,6 +2921,10 @@ def test_suite():
             setUp=zc.zk.testing.setUp, tearDown=zc.zk.testing.tearDown,
             checker=checker,
             ),
+        doctest.DocFileSuite(
+            'server.test',
+            optionflags=doctest.NORMALIZE_WHITESPACE,
+            ),
         doctest.DocFileSuite(
             'monitor.test',
             checker = zope.testing.renormalizing.RENormalizing([